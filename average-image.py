@@ -1,49 +1,69 @@
 #######################################################################
 # use numpy to average camera images
+# each frame is added into a running sum as it arrives, so memory use doesn't grow with count.
+# It also prints the average per pixel noise, the standard deviation across the frames.
+# With opencv installed, and a display, it shows the first and the averaged image, press a key to close them.
 #
 # Author: Garry Morrison
 # email: garry.morrison _at_ gmail.com
 # Date: 26/4/2018
-# Update: 26/4/2018
+# Update: 18/10/2026
 # Copyright: GPLv3
 #
-# Usage: python3 average-camera-images.py
+# Usage: python3 average-image.py
+#   (SMART_CAR_CAMERA picks the camera backend, see camera.py)
 #
 #######################################################################
 
+import os
+import sys
 import numpy as np
-import cv2
+import pygame
+from camera import open_camera, camera_flip, FramePipeline
+from image_tools import FrameAccumulator
 
-count = 20
+try:
+    import cv2
+    have_opencv = True
+except ImportError:
+    have_opencv = False
 
-cap = cv2.VideoCapture(0)
+count = 20
+camera_size = (640, 480)
 
-# create a list of first count frames:
-img = [cap.read()[1] for i in range(count)]
+pygame.init()
+cam = open_camera(camera_size)
+if cam is None:
+    print('failed to find a camera')
+    sys.exit(-1)
+cam.start()
 
-# rotate images:
-rot_img = [cv2.flip(i, -1) for i in img]
+# rotate images, by the camera if it can, otherwise by us:
+hflip, vflip = camera_flip(cam, True, True)
+pipeline = FramePipeline(cam.get_size(), hflip, vflip)
 
-# convert all to float64:
-float_img = [np.float64(i) for i in rot_img]
+# add up the first count frames, keeping a copy of the first one:
+acc = FrameAccumulator(variance=True)
+for k in range(count):
+    img = pipeline.process(cam.get_image())
+    if k == 0:
+        raw_img = img.copy()
+    acc.add(pygame.surfarray.pixels3d(img))
+    del img  # unlock the surface
+cam.stop()
 
 # find the average:
-mean_img = float_img[0]
-for k in range(1, count):
-    mean_img += float_img[k]
-mean_img /= count
-
-# Convert back to uint8:
-int_mean_img = np.uint8(np.clip(mean_img, 0, 255))
-
-# show output:
-cv2.imshow('initial', rot_img[0])
-cv2.imshow('average', int_mean_img)
+int_mean_img = acc.image()
+print('averaged %s images, mean noise %.2f' % (acc.count, np.mean(np.sqrt(acc.variance()))))
 
 # save output:
-cv2.imwrite('raw-image.png', rot_img[0])
-cv2.imwrite('ave-image.png', int_mean_img)
+pygame.image.save(raw_img, 'raw-image.png')
+pygame.image.save(pygame.surfarray.make_surface(int_mean_img), 'ave-image.png')
+print('saved raw-image.png and ave-image.png')
 
-# tidy up and quit:
-cv2.waitKey(0)
-cv2.destroyAllWindows()
+# show output, opencv wants BGR indexed [y, x]:
+if have_opencv and os.environ.get('DISPLAY'):
+    cv2.imshow('initial', pygame.surfarray.array3d(raw_img).transpose(1, 0, 2)[:, :, ::-1])
+    cv2.imshow('average', int_mean_img.transpose(1, 0, 2)[:, :, ::-1])
+    cv2.waitKey(0)
+    cv2.destroyAllWindows()
@@ -0,0 +1,747 @@
+#######################################################################
+# camera code for the smart car
+#
+# cam.get_image() waits for the next frame from the camera,
+# so the GUI used to only ask for one every 25 times around the main loop, about one frame a second.
+# CaptureThread instead sits in get_image() on its own thread,
+# capturing into two surfaces in turn, the back one being filled while the front one is the newest frame.
+# The GUI just looks at the front surface whenever it likes, and never waits on the camera.
+#
+# FramePipeline gets each frame ready to show, scaling (only if the size is wrong) and flipping
+# into surfaces it made once, rather than a new surface per step per frame.
+# With debug on, it counts surface allocations and garbage collections per frame.
+# The capture side is counted too, CaptureThread's own surfaces, and the frames and surfaces
+# the camera backend makes (opencv reads into the same array every time, a replayed image has to be loaded).
+# With smooth on, it shrinks with pygame's smoothscale, which averages over the area of each pixel,
+# so a full resolution capture makes a clean preview, rather than just skipping pixels.
+#
+# Flipping is best done by the camera itself, so camera_flip() asks for it with set_controls(),
+# and checks with get_controls() whether it took. Only what the camera can't do is left to the pipeline,
+# which then does the scale and the flip together, in one numpy gather.
+#
+# open_camera() picks where the frames come from, all with the same interface as pygame.camera.Camera,
+# so the rest of the code doesn't care:
+#   opencv          - cv2.VideoCapture with V4L2, asking for MJPEG and a small buffer, usually the fastest,
+#                     and it asks the V4L2 driver for the flip, like pygame.camera does
+#   pygame          - pygame.camera
+#   replay:<path>   - replay a directory of images, or a video file (needs opencv)
+#   synthetic       - a generated moving test pattern, no camera needed
+# Set SMART_CAR_CAMERA to one of those, otherwise we use the first of opencv, then pygame, that works.
+#
+# FrameStats keeps track of how stale the preview is: the time between camera frames, the time spent
+# on each step of getting a frame on the screen, the latency from capture to display,
+# and frames dropped (captured but never shown) or repeated (a preview frame was due, but the camera had nothing new).
+# It prints a summary every log_interval seconds, and can draw it over the preview.
+#
+# PreviewScheduler decides how often the GUI shows a new frame, and how long the main loop sleeps.
+# It measures how long a loop takes with and without a new frame, and spaces the frames out
+# so the preview uses at most share of the main loop's time, while the loop still comes back around
+# within budget seconds to handle input. So at 320x240 we show every camera frame,
+# and at 800x600 the preview slows down rather than the buttons.
+#
+# Author: Garry Morrison
+# email: garry.morrison _at_ gmail.com
+# Date: 18/10/2026
+# Update: 18/10/2026
+# Copyright: GPLv3
+#
+# Usage:
+#   capture = CaptureThread(cam)
+#   capture.start()
+#   with capture.lock:
+#       if capture.sequence != shown:
+#           shown = capture.sequence
+#           screen.blit(capture.front, (2, 2))
+#   capture.close()
+#
+#   hflip, vflip = camera_flip(cam, hflip, vflip)
+#   pipeline = FramePipeline(camera_size, hflip, vflip)
+#   screen.blit(pipeline.process(img), (2, 2))
+#   print(pipeline.report())
+#
+#   cam = open_camera(camera_size)
+#
+#   frame_stats = FrameStats(capture)
+#   frame_stats.new_frame(capture.sequence, capture.frame_time)
+#   frame_stats.stage('blit', start_time)
+#   frame_stats.displayed()
+#
+#   preview = PreviewScheduler(budget=0.05)
+#   while True:
+#       preview.start_loop()
+#       if preview.due() and there is a new frame:
+#           ... show it
+#           preview.shown()
+#       ...
+#       pygame.time.wait(preview.end_loop())
+#
+#   or, to benchmark a camera backend, headless if need be:
+#   SMART_CAR_CAMERA=synthetic python3 camera.py [frames]
+#
+#######################################################################
+
+import fcntl
+import gc
+import os
+import struct
+import sys
+import threading
+import time
+import numpy as np
+import pygame
+from histogram import Histogram
+
+try:
+    import cv2
+    have_opencv = True
+except ImportError:
+    have_opencv = False
+
+
+class CaptureThread():
+    def __init__(self, cam):
+        self.cam = cam
+        self.front = None  # the newest frame, only touch it while holding the lock
+        self.back = None  # the frame being captured
+        self.sequence = 0  # goes up by one for every new frame
+        self.allocations = 0  # how many surfaces we have made, the camera's own are counted by the camera
+        self.frame_time = None  # time.monotonic() when the front frame arrived
+        self.intervals = Histogram()  # time between frames
+        self.capture_time = Histogram()  # time spent in get_image()
+        self.on_frame = []  # each is called with (img, frame_time) for every frame, from the capture thread, once it is published, eg, to record it
+        self.lock = threading.Lock()
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name='capture', daemon=True)
+        self.thread.start()
+
+    def close(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join(1)
+            self.thread = None
+
+    def capture(self):
+        if self.back is None:
+            # first frame, let the camera make the surface, so it has the right size and format.
+            # (that one is counted by the camera backend, if it counts)
+            return self.cam.get_image()
+        return self.cam.get_image(self.back)
+
+    def report(self):
+        frames = max(self.sequence, 1)
+        text = 'capture: %s frames, %s surface allocations (%.3f per frame)' % (self.sequence, self.allocations, self.allocations / frames)
+        # our own backends count theirs, pygame.camera doesn't:
+        allocations = getattr(self.cam, 'allocations', None)
+        if allocations is not None:
+            text += ', camera backend %s allocations (%.3f per frame)' % (allocations, allocations / frames)
+        return text
+
+    def run(self):
+        while self.running:
+            start_time = time.monotonic()
+            try:
+                img = self.capture()
+            except Exception as e:
+                print('capture exception: %s' % e)
+                time.sleep(0.1)
+                continue
+            now = time.monotonic()
+            with self.lock:
+                self.capture_time.add(now - start_time)
+                if self.frame_time is not None:
+                    self.intervals.add(now - self.frame_time)
+                self.back = self.front
+                self.front = img
+                self.sequence += 1
+                self.frame_time = now
+            if self.back is None:
+                self.back = img.copy()
+                self.allocations += 1
+            # after the frame is on the front, so the GUI never waits on these.
+            # (img is only read from here on, the next capture goes into the back surface)
+            for on_frame in self.on_frame:
+                on_frame(img, now)
+
+
+# ask the camera to do the flipping, returns the (hflip, vflip) still left for us to do in software:
+# Each flip is checked on its own, the camera may take one and not the other,
+# or fail half way through setting them.
+def camera_flip(cam, hflip, vflip):
+    if not hflip and not vflip:
+        return False, False
+    try:
+        cam.set_controls(hflip=hflip, vflip=vflip)
+    except Exception as e:
+        # set_controls() has been known to bug out in python 3:
+        print('camera controls exception: %s' % e)
+    try:
+        controls = cam.get_controls()
+        camera_hflip = bool(controls[0])
+        camera_vflip = bool(controls[1])
+    except Exception as e:
+        print('camera controls exception: %s' % e)
+        camera_hflip = camera_vflip = False
+    # whatever the camera ended up doing, we do the rest:
+    hflip, vflip = hflip != camera_hflip, vflip != camera_vflip
+    print('camera flip: %s' % ('software' if hflip or vflip else 'hardware'))
+    if (hflip or vflip) and (camera_hflip or camera_vflip):
+        print('  (the camera flips %s, we flip %s)' % ('h' if camera_hflip else 'v', 'h' if hflip else 'v'))
+    return hflip, vflip
+
+
+class FramePipeline():
+    def __init__(self, size, hflip=False, vflip=False, debug=False, smooth=False):
+        self.size = size
+        self.hflip = hflip
+        self.vflip = vflip
+        self.smooth = smooth  # area average when shrinking, instead of nearest neighbour
+        self.dest = None  # made on first use, then reused for every frame
+        self.scaled = None  # for frames that get scaled then flipped
+        self.buffer = None  # half way through a fused scale and flip
+        self.source_size = None
+        self.columns = None  # for each destination pixel, which source pixel it comes from
+        self.rows = None
+        self.path = None  # what we did to the last frame
+
+        self.debug = debug
+        self.frames = 0
+        self.allocations = 0
+        self.collections = 0
+        self.gc_count = None
+
+    # a new surface like img, but the given size:
+    def allocate(self, size, img):
+        self.allocations += 1
+        return pygame.Surface(size, 0, img)
+
+    # returns the frame ready to show, which is either img itself, or our own surface,
+    # so it is only good till the next call:
+    def process(self, img):
+        if self.debug:
+            self.count_garbage()
+        self.frames += 1
+
+        flip = self.hflip or self.vflip
+        scale = img.get_size() != self.size
+        if not flip and not scale:
+            self.path = 'none'
+            return img
+
+        if self.dest is None or self.dest.get_bitsize() != img.get_bitsize():
+            self.dest = self.allocate(self.size, img)
+        smooth = self.smooth and img.get_bytesize() >= 3 and img.get_width() > self.size[0]
+        scale_to = pygame.transform.smoothscale if smooth else pygame.transform.scale
+        if not flip:
+            self.path = 'smooth scale' if smooth else 'scale'
+            scale_to(img, self.size, self.dest)
+        elif not scale:
+            self.path = 'flip'
+            self.flip(img, self.dest)
+        elif img.get_bytesize() == 4 and not smooth:
+            self.path = 'scale and flip'
+            self.scale_and_flip(img, self.dest)
+        else:
+            # the one pass version needs 32 bit pixels, and is only nearest neighbour.
+            # So with smooth on it never runs, but shrinking 1024x768 to 640x480, smoothscale then
+            # a 32 bit flip (about 3.2ms) is quicker than the fused lookup anyway (about 5.9ms):
+            self.path = 'smooth scale, then flip' if smooth else 'scale, then flip'
+            if self.scaled is None or self.scaled.get_bitsize() != img.get_bitsize():
+                self.scaled = self.allocate(self.size, img)
+            scale_to(img, self.size, self.scaled)
+            self.flip(self.scaled, self.dest)
+        return self.dest
+
+    # pygame.transform.flip() always makes a new surface, so flip with numpy into one we already have.
+    # (surfarray is indexed [x, y], and we drop the arrays straight away to unlock the surfaces)
+    # 32 bit pixels can be moved as one uint32 each, which is much faster than as 3 bytes:
+    def flip(self, img, dest):
+        pixels = pygame.surfarray.pixels2d if img.get_bytesize() == 4 else pygame.surfarray.pixels3d
+        src = pixels(img)
+        dst = pixels(dest)
+        np.copyto(dst, src[::-1 if self.hflip else 1, ::-1 if self.vflip else 1])
+        del src, dst
+
+    # nearest neighbour scale, the same as pygame.transform.scale(), with the flip folded into the lookup:
+    def scale_and_flip(self, img, dest):
+        if img.get_size() != self.source_size:
+            self.source_size = img.get_size()
+            self.columns = np.arange(self.size[0]) * self.source_size[0] // self.size[0]
+            self.rows = np.arange(self.size[1]) * self.source_size[1] // self.size[1]
+            if self.hflip:
+                self.columns = self.columns[::-1].copy()
+            if self.vflip:
+                self.rows = self.rows[::-1].copy()
+            self.buffer = np.empty((self.size[0], self.source_size[1]), np.uint32)
+        src = pygame.surfarray.pixels2d(img)
+        dst = pygame.surfarray.pixels2d(dest)
+        np.take(src, self.columns, axis=0, out=self.buffer, mode='clip')
+        np.take(self.buffer, self.rows, axis=1, out=dst, mode='clip')
+        del src, dst
+
+    def count_garbage(self):
+        count = sum(stats['collections'] for stats in gc.get_stats())
+        if self.gc_count is not None:
+            self.collections += count - self.gc_count
+        self.gc_count = count
+
+    def report(self):
+        frames = max(self.frames, 1)
+        text = 'frame pipeline: %s frames, %s, %s surface allocations (%.3f per frame)' % (
+            self.frames, self.path, self.allocations, self.allocations / frames)
+        if self.debug:
+            text += ', %s garbage collections (%.3f per frame)' % (self.collections, self.collections / frames)
+        return text
+
+
+# the frame timings are over a rolling window, the stats are reset after every log line:
+class FrameStats():
+    def __init__(self, capture, log_interval=10):
+        self.capture = capture
+        self.log_interval = log_interval
+        self.stages = {}  # stage name -> Histogram, in the order they first happen
+        self.latency = Histogram()
+        self.shown = 0
+        self.dropped = 0
+        self.repeated = 0
+        self.sequence = None  # last frame we showed
+        self.frame_time = None  # when it was captured, if it hasn't been displayed yet
+        self.waiting = False  # a frame was due, and we are still waiting on the camera for it
+        self.log_time = time.monotonic()
+        self.font = None
+
+    def reset(self):
+        for histogram in self.stages.values():
+            histogram.reset()
+        self.latency.reset()
+        self.shown = 0
+        self.dropped = 0
+        self.repeated = 0
+        with self.capture.lock:
+            self.capture.intervals.reset()
+            self.capture.capture_time.reset()
+
+    # we are about to show this frame:
+    def new_frame(self, sequence, frame_time):
+        if self.sequence is not None and sequence > self.sequence + 1:
+            self.dropped += sequence - self.sequence - 1
+        self.sequence = sequence
+        self.frame_time = frame_time
+        self.waiting = False
+        self.shown += 1
+
+    # a preview frame was due, but there is no new one from the camera,
+    # counted once per wait, however many times around the main loop it takes:
+    def missed(self):
+        if not self.waiting:
+            self.waiting = True
+            self.repeated += 1
+
+    # a step of getting the frame on the screen, that started at start_time, has just finished:
+    def stage(self, name, start_time):
+        if name not in self.stages:
+            self.stages[name] = Histogram()
+        self.stages[name].add(time.monotonic() - start_time)
+
+    # call straight after pygame.display.flip():
+    def displayed(self):
+        now = time.monotonic()
+        if self.frame_time is not None:
+            self.latency.add(now - self.frame_time)
+            self.frame_time = None
+        if now - self.log_time >= self.log_interval:
+            print(self.log_line(now - self.log_time), flush=True)
+            self.log_time = now
+            self.reset()
+
+    def lines(self):
+        with self.capture.lock:
+            lines = [
+                'capture interval: %s' % self.capture.intervals.summary(),
+                'capture: %s' % self.capture.capture_time.summary(),
+            ]
+        for name, histogram in self.stages.items():
+            lines.append('%s: %s' % (name, histogram.summary()))
+        lines.append('capture to display: %s' % self.latency.summary())
+        lines.append('shown %s, dropped %s, repeated %s' % (self.shown, self.dropped, self.repeated))
+        return lines
+
+    def log_line(self, seconds):
+        with self.capture.lock:
+            camera_fps = self.capture.intervals.count / seconds
+        return 'frames: camera %.1ffps, shown %.1ffps, dropped %s, repeated %s, latency p50 %.0fms p95 %.0fms' % (
+            camera_fps, self.shown / seconds, self.dropped, self.repeated,
+            1000 * self.latency.percentile(50), 1000 * self.latency.percentile(95))
+
+    # draw the stats over the preview, on a black background so it doesn't smear:
+    def draw(self, screen, pos):
+        if self.font is None:
+            self.font = pygame.font.SysFont('Verdana', 12)
+        x, y = pos
+        for line in self.lines():
+            text_surf = self.font.render(line, 1, (255, 255, 255), (0, 0, 0))
+            screen.blit(text_surf, (x, y))
+            y += text_surf.get_height()
+
+
+class PreviewScheduler():
+    def __init__(self, budget=0.05, share=0.5, min_interval=1 / 60):
+        self.budget = budget  # the main loop should come back around within this many seconds
+        self.share = share  # the most of the main loop's time the preview can have
+        self.min_interval = min_interval
+        self.interval = min_interval  # time between preview frames
+        self.frame_cost = None  # running averages of how long a loop takes, with a new frame, and without
+        self.idle_cost = None
+        self.loop_start = None
+        self.showed_frame = False
+        self.next_frame_time = 0
+        self.over_budget = 0  # loops that took longer than the budget
+
+    def start_loop(self):
+        self.loop_start = time.monotonic()
+        self.showed_frame = False
+
+    def due(self):
+        return time.monotonic() >= self.next_frame_time
+
+    def shown(self):
+        self.showed_frame = True
+        self.next_frame_time = self.loop_start + self.interval
+
+    # returns how many ms to sleep before the next loop:
+    def end_loop(self):
+        now = time.monotonic()
+        cost = now - self.loop_start
+        if cost > self.budget:
+            self.over_budget += 1
+        if self.showed_frame:
+            self.frame_cost = cost if self.frame_cost is None else self.frame_cost + 0.1 * (cost - self.frame_cost)
+        else:
+            self.idle_cost = cost if self.idle_cost is None else self.idle_cost + 0.1 * (cost - self.idle_cost)
+
+        # what a frame costs on top of an ordinary loop, decides how far apart the frames have to be:
+        if self.frame_cost is not None:
+            extra_cost = self.frame_cost - (self.idle_cost or 0)
+            self.interval = max(self.min_interval, extra_cost / self.share)
+
+        # sleep till the next frame is due (or if it is already due, check for one every min_interval),
+        # but never so long that input waits more than the budget:
+        wake_time = min(self.loop_start + self.budget, max(self.next_frame_time, now + self.min_interval))
+        return max(1, int(1000 * (wake_time - now)))
+
+    def report(self):
+        return 'preview: %.0fms between frames (%.1ffps max), loop %.1fms, plus %.1fms with a frame, %s loops over the %.0fms budget' % (
+            1000 * self.interval, 1 / self.interval, 1000 * (self.idle_cost or 0),
+            1000 * max(0, (self.frame_cost or 0) - (self.idle_cost or 0)), self.over_budget, 1000 * self.budget)
+
+
+# copy an opencv BGR frame, indexed [y, x], into a pygame surface, indexed [x, y]:
+def frame_to_surface(frame, surface=None):
+    if surface is None:
+        surface = pygame.Surface((frame.shape[1], frame.shape[0]), 0, 32)
+    dst = pygame.surfarray.pixels3d(surface)
+    np.copyto(dst, frame.transpose(1, 0, 2)[:, :, ::-1])
+    del dst
+    return surface
+
+
+# the parts of the pygame.camera.Camera interface the other backends have in common.
+# By default they have no hardware controls, so flipping is left to FramePipeline:
+class CameraSource():
+    def __init__(self, size):
+        self.size = size
+        self.allocations = 0  # frames and surfaces we have had to make
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def get_size(self):
+        return self.size
+
+    def query_image(self):
+        return True
+
+    def get_controls(self):
+        return False, False, 0
+
+    def set_controls(self, hflip=False, vflip=False, brightness=0):
+        return self.get_controls()
+
+
+# V4L2 controls, from linux/videodev2.h:
+V4L2_CID_BRIGHTNESS = 0x00980900
+V4L2_CID_HFLIP = 0x00980914
+V4L2_CID_VFLIP = 0x00980915
+VIDIOC_G_CTRL = 0xc008561b  # _IOWR('V', 27, struct v4l2_control)
+VIDIOC_S_CTRL = 0xc008561c  # _IOWR('V', 28, struct v4l2_control)
+
+
+class OpenCVCamera(CameraSource):
+    def __init__(self, device=0, size=(640, 480), fps=30, buffers=1, fourcc='MJPG'):
+        CameraSource.__init__(self, size)
+        self.device = device
+        self.fps = fps
+        self.buffers = buffers  # a small buffer means we get the newest frame, not one from a while ago
+        self.fourcc = fourcc  # MJPEG gets the full frame rate over USB at sizes where raw YUYV can't
+        self.cap = None
+        self.frame = None  # opencv reads into this, every time
+
+    def start(self):
+        self.cap = cv2.VideoCapture(self.device, cv2.CAP_V4L2)
+        if not self.cap.isOpened():
+            raise IOError('failed to open camera %s' % self.device)
+        if self.fourcc:
+            self.cap.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*self.fourcc))
+        self.cap.set(cv2.CAP_PROP_FRAME_WIDTH, self.size[0])
+        self.cap.set(cv2.CAP_PROP_FRAME_HEIGHT, self.size[1])
+        if self.fps:
+            self.cap.set(cv2.CAP_PROP_FPS, self.fps)
+        self.cap.set(cv2.CAP_PROP_BUFFERSIZE, self.buffers)
+        self.size = (int(self.cap.get(cv2.CAP_PROP_FRAME_WIDTH)), int(self.cap.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+
+    def stop(self):
+        if self.cap is not None:
+            self.cap.release()
+            self.cap = None
+
+    # get or set one V4L2 control, opencv has no flip properties, so we go to the driver ourselves,
+    # on our own file handle, which V4L2 allows alongside the capture one:
+    def v4l2_control(self, request, cid, value=0):
+        device = self.device if isinstance(self.device, str) else '/dev/video%s' % self.device
+        with open(device, 'rb', buffering=0) as f:
+            data = fcntl.ioctl(f, request, struct.pack('Ii', cid, value))
+        return struct.unpack('Ii', data)[1]
+
+    # (hflip, vflip, brightness), as for pygame.camera, raises OSError if the camera has no such controls:
+    def get_controls(self):
+        return (bool(self.v4l2_control(VIDIOC_G_CTRL, V4L2_CID_HFLIP)), bool(self.v4l2_control(VIDIOC_G_CTRL, V4L2_CID_VFLIP)),
+                self.v4l2_control(VIDIOC_G_CTRL, V4L2_CID_BRIGHTNESS))
+
+    def set_controls(self, hflip=False, vflip=False, brightness=None):
+        self.v4l2_control(VIDIOC_S_CTRL, V4L2_CID_HFLIP, int(hflip))
+        self.v4l2_control(VIDIOC_S_CTRL, V4L2_CID_VFLIP, int(vflip))
+        if brightness is not None:
+            self.v4l2_control(VIDIOC_S_CTRL, V4L2_CID_BRIGHTNESS, brightness)
+        return self.get_controls()
+
+    # the raw opencv BGR frame, it is only good till the next read():
+    def read(self):
+        ok, frame = self.cap.read(self.frame)
+        if not ok:
+            raise IOError('failed to read from camera %s' % self.device)
+        if frame is not self.frame:
+            # the first frame, or the size changed:
+            self.allocations += 1
+            self.frame = frame
+        return frame
+
+    def get_image(self, surface=None):
+        if surface is None:
+            self.allocations += 1
+        return frame_to_surface(self.read(), surface)
+
+
+# replay a directory of images (in name order), or a video file, at fps frames a second, looping at the end:
+class ReplayCamera(CameraSource):
+    def __init__(self, path, size=None, fps=30, loop=True):
+        CameraSource.__init__(self, size)
+        self.path = path
+        self.fps = fps
+        self.loop = loop
+        self.files = None
+        self.video = None
+        self.frame = None  # video frames are read into this
+        self.scaled = None  # loaded images are scaled into this
+        self.position = 0
+        self.next_time = None
+
+    def start(self):
+        if os.path.isdir(self.path):
+            self.files = sorted(os.path.join(self.path, name) for name in os.listdir(self.path)
+                                if name.lower().endswith(('.png', '.jpg', '.jpeg', '.bmp')))
+            if not self.files:
+                raise IOError('no images in %s' % self.path)
+            first = pygame.image.load(self.files[0])
+        else:
+            if not have_opencv:
+                raise IOError('replaying a video needs opencv')
+            self.video = cv2.VideoCapture(self.path)
+            if not self.video.isOpened():
+                raise IOError('failed to open %s' % self.path)
+            first = frame_to_surface(self.read())
+            self.video.set(cv2.CAP_PROP_POS_FRAMES, 0)
+        if self.size is None:
+            self.size = first.get_size()
+        self.next_time = time.monotonic()
+
+    def stop(self):
+        if self.video is not None:
+            self.video.release()
+            self.video = None
+
+    def read(self):
+        ok, frame = self.video.read(self.frame)
+        if not ok and self.loop:
+            self.video.set(cv2.CAP_PROP_POS_FRAMES, 0)
+            ok, frame = self.video.read(self.frame)
+        if not ok:
+            raise IOError('end of %s' % self.path)
+        if frame is not self.frame:
+            self.allocations += 1
+            self.frame = frame
+        return frame
+
+    # wait till the next frame is due, like a real camera would:
+    def wait(self):
+        if self.fps:
+            delay = self.next_time - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            self.next_time = max(self.next_time + 1 / self.fps, time.monotonic())
+
+    def get_image(self, surface=None):
+        self.wait()
+        if surface is None:
+            surface = pygame.Surface(self.size, 0, 32)
+            self.allocations += 1
+        if self.video is not None:
+            frame = self.read()
+            if (frame.shape[1], frame.shape[0]) == surface.get_size():
+                return frame_to_surface(frame, surface)
+            img = frame_to_surface(frame)
+            self.allocations += 1
+        else:
+            if self.position >= len(self.files):
+                if not self.loop:
+                    raise IOError('end of %s' % self.path)
+                self.position = 0
+            # there is no loading into a surface we already have:
+            img = pygame.image.load(self.files[self.position])
+            self.allocations += 1
+            self.position += 1
+        if img.get_size() != surface.get_size():
+            if self.scaled is None or self.scaled.get_bitsize() != img.get_bitsize() or self.scaled.get_size() != surface.get_size():
+                self.scaled = pygame.Surface(surface.get_size(), 0, img)
+                self.allocations += 1
+            img = pygame.transform.scale(img, surface.get_size(), self.scaled)
+        surface.blit(img, (0, 0))
+        return surface
+
+
+# a moving test pattern, colour gradients with a bar sweeping across, at fps frames a second:
+class SyntheticCamera(CameraSource):
+    def __init__(self, size=(640, 480), fps=30):
+        CameraSource.__init__(self, size)
+        self.fps = fps
+        self.count = 0
+        self.next_time = None
+        width, height = size
+        self.background = np.zeros((width, height, 3), np.uint8)
+        self.background[:, :, 0] = np.linspace(0, 255, width, dtype=np.uint8)[:, None]
+        self.background[:, :, 1] = np.linspace(0, 255, height, dtype=np.uint8)[None, :]
+        self.background[:, :, 2] = 128
+
+    def start(self):
+        self.next_time = time.monotonic()
+
+    def get_image(self, surface=None):
+        if self.fps:
+            delay = self.next_time - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            self.next_time = max(self.next_time + 1 / self.fps, time.monotonic())
+        if surface is None:
+            surface = pygame.Surface(self.size, 0, 32)
+            self.allocations += 1
+        width = self.size[0]
+        x = (self.count * 8) % width
+        dst = pygame.surfarray.pixels3d(surface)
+        np.copyto(dst, self.background)
+        dst[x:x + width // 20] = 255
+        del dst
+        self.count += 1
+        return surface
+
+
+def open_pygame_camera(size):
+    import pygame.camera
+    pygame.camera.init()
+    camera_list = pygame.camera.list_cameras()
+    if not camera_list:
+        raise IOError('pygame found no cameras')
+    return pygame.camera.Camera(camera_list[0], size)
+
+
+def open_opencv_camera(size):
+    if not have_opencv:
+        raise IOError('opencv is not installed')
+    cam = OpenCVCamera(0, size)
+    # open it now, so we know it works:
+    cam.start()
+    cam.stop()
+    return cam
+
+
+# returns a camera that hasn't been started yet, or None if we can't find one.
+# backend is as for SMART_CAR_CAMERA, described at the top of the file:
+def open_camera(size, backend=None):
+    if backend is None:
+        backend = os.environ.get('SMART_CAR_CAMERA')
+    if backend is None:
+        backends = ['opencv', 'pygame']
+    else:
+        backends = [backend]
+
+    for backend in backends:
+        try:
+            if backend == 'opencv':
+                cam = open_opencv_camera(size)
+            elif backend == 'pygame':
+                cam = open_pygame_camera(size)
+            elif backend == 'synthetic':
+                cam = SyntheticCamera(size)
+            elif backend.startswith('replay:'):
+                cam = ReplayCamera(backend[len('replay:'):], size)
+            else:
+                print('unknown camera backend: %s' % backend)
+                continue
+            print('camera backend: %s' % backend)
+            return cam
+        except (ImportError, IOError, pygame.error) as e:
+            print('camera %s exception: %s' % (backend, e))
+    return None
+
+
+# time count frames from the camera, through the capture and display pipeline:
+def benchmark(count=200, size=(640, 480)):
+    cam = open_camera(size)
+    if cam is None:
+        print('failed to find a camera')
+        return
+    cam.start()
+    pipeline = FramePipeline(size, False, True, debug=True)
+    img = cam.get_image()
+    start_time = time.monotonic()
+    for _ in range(count):
+        img = cam.get_image(img)
+        pipeline.process(img)
+    delta_time = time.monotonic() - start_time
+    cam.stop()
+    print('camera size %s, %s frames in %.2fs, %.1f frames/s' % (str(cam.get_size()), count, delta_time, count / delta_time))
+    print(pipeline.report())
+    allocations = getattr(cam, 'allocations', None)
+    if allocations is not None:
+        print('camera backend: %s allocations (%.3f per frame)' % (allocations, allocations / count))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) >= 2:
+        benchmark(int(sys.argv[1]))
+    else:
+        benchmark()
@@ -0,0 +1,370 @@
+#######################################################################
+# shared i2c bus code for the smart car
+#
+# the GUI callbacks used to write straight to the bus, each write followed by a 1ms sleep,
+# so dragging a slider or the camera map would stall the pygame event loop.
+# Now callers just queue up (cmd, value) pairs, and a single writer thread sends them.
+# If the same register is written again before the thread gets to it, only the newest value is sent.
+# A shadow copy of the registers also lets us skip writes that wouldn't change anything.
+# Writes are sent most urgent first, so a motor stop never waits behind LED's or the buzzer.
+# And ProfiledBus can wrap the bus, to see where all the bus time goes.
+#
+# Author: Garry Morrison
+# email: garry.morrison _at_ gmail.com
+# Date: 18/10/2026
+# Update: 18/10/2026
+# Copyright: GPLv3
+#
+# Usage:
+#   bus_writer = BusWriter(bus, smbus_address, shadow=ShadowRegisters())
+#   bus_writer.start()
+#   bus_writer.write(CMD_SERVO2, 1500)
+#   ...
+#   ticket = bus_writer.write(CMD_IO1, 0)
+#   bus_writer.wait_written(CMD_IO1, ticket, 0.02)   # just this write, not the whole queue
+#   bus_writer.stop()
+#
+#   to profile the bus, wrap it first:
+#   bus = ProfiledBus(bus)
+#   bus.dump_on_signal()   # kill -USR1 <pid>, and again at exit
+#
+#######################################################################
+
+import atexit
+import signal
+import threading
+import time
+from histogram import Histogram
+
+
+# define IO constants:
+CMD_SERVO1 = 0
+CMD_SERVO2 = 1
+CMD_SERVO3 = 2
+CMD_SERVO4 = 3
+CMD_PWM1 = 4
+CMD_PWM2 = 5
+CMD_DIR1 = 6
+CMD_DIR2 = 7
+CMD_BUZZER = 8
+CMD_IO1 = 9
+CMD_IO2 = 10
+CMD_IO3 = 11
+CMD_SONIC = 12
+
+register_names = {
+    CMD_SERVO1: 'SERVO1',
+    CMD_SERVO2: 'SERVO2',
+    CMD_SERVO3: 'SERVO3',
+    CMD_SERVO4: 'SERVO4',
+    CMD_PWM1: 'PWM1',
+    CMD_PWM2: 'PWM2',
+    CMD_DIR1: 'DIR1',
+    CMD_DIR2: 'DIR2',
+    CMD_BUZZER: 'BUZZER',
+    CMD_IO1: 'IO1',
+    CMD_IO2: 'IO2',
+    CMD_IO3: 'IO3',
+    CMD_SONIC: 'SONIC',
+}
+
+
+# keep a copy of the last value successfully written to each register (keyed by the CMD_* constants),
+# so we can skip writes that wouldn't change anything, eg, CMD_DIR1 = 1 on every forward press.
+# If we are ever unsure what the car has (eg, after a bus error) invalidate() forces the next write through.
+class ShadowRegisters():
+    def __init__(self):
+        self.values = {}
+        self.hits = 0  # writes skipped
+        self.misses = 0  # writes that went to the bus
+        self.lock = threading.Lock()
+
+    def needs_write(self, cmd, value):
+        with self.lock:
+            if self.values.get(cmd) == value:
+                self.hits += 1
+                return False
+            self.misses += 1
+            return True
+
+    def update(self, cmd, value):
+        with self.lock:
+            self.values[cmd] = value
+
+    def invalidate(self, cmd=None):
+        with self.lock:
+            if cmd is None:
+                self.values.clear()
+            else:
+                self.values.pop(cmd, None)
+
+    def report(self):
+        total = self.hits + self.misses
+        if total == 0:
+            return 'shadow registers: no writes'
+        return 'shadow registers: %s of %s writes skipped (%.1f%%)' % (self.hits, total, 100 * self.hits / total)
+
+
+# priority classes, most urgent first.
+# A motor stop always jumps the queue, ahead of everything else:
+PRIORITY_STOP = 0
+PRIORITY_MOTOR = 1
+PRIORITY_STEERING = 2
+PRIORITY_CAMERA = 3
+PRIORITY_COSMETIC = 4  # LED's and buzzer
+PRIORITY_DEFERRED = 5  # writes that waited longer than drop_after, only sent once nothing else is waiting
+
+priority_names = ['stop', 'motor', 'steering', 'camera', 'cosmetic', 'deferred']
+
+register_priority = {
+    CMD_PWM1: PRIORITY_MOTOR,
+    CMD_PWM2: PRIORITY_MOTOR,
+    CMD_DIR1: PRIORITY_MOTOR,
+    CMD_DIR2: PRIORITY_MOTOR,
+    CMD_SERVO1: PRIORITY_STEERING,
+    CMD_SERVO2: PRIORITY_CAMERA,
+    CMD_SERVO3: PRIORITY_CAMERA,
+    CMD_SERVO4: PRIORITY_CAMERA,
+    CMD_BUZZER: PRIORITY_COSMETIC,
+    CMD_IO1: PRIORITY_COSMETIC,
+    CMD_IO2: PRIORITY_COSMETIC,
+    CMD_IO3: PRIORITY_COSMETIC,
+}
+
+
+def write_priority(cmd, value):
+    if cmd in (CMD_PWM1, CMD_PWM2) and value == 0:
+        return PRIORITY_STOP
+    return register_priority.get(cmd, PRIORITY_COSMETIC)
+
+
+# The writer always sends the most urgent pending write next, so a stop waits for at most one
+# transaction already on the bus, no matter how many LED or buzzer writes are queued up.
+# Less urgent writes are deferred while more urgent ones are waiting,
+# and if drop_after is set for a priority, writes that have waited longer than that are deferred,
+# to be sent only when the bus is otherwise idle. They are never dropped, the queue only holds
+# the newest value for each register, so dropping it would leave, eg, the buzzer on for good.
+# eg, BusWriter(bus, drop_after={PRIORITY_COSMETIC: 0.5})
+class BusWriter():
+    def __init__(self, bus, address=0x18, write_delay=0.001, shadow=None, drop_after=None):
+        self.bus = bus
+        self.address = address
+        self.write_delay = write_delay  # the controller needs a short gap between writes
+        self.shadow = shadow  # optional ShadowRegisters
+        self.drop_after = drop_after or {}  # priority -> max seconds a write can wait
+        self.pending = [{} for _ in priority_names]  # per priority: cmd -> (value, queued time, ticket), in the order they should be sent
+        self.pending_priority = {}  # cmd -> which pending dict it is in
+        self.tickets = 0  # every write gets the next ticket number
+        self.completed = {}  # cmd -> newest ticket that has been written or skipped (the shadow says it is already there)
+        self.busy = False  # True while the thread is in the middle of a bus write
+        self.running = False
+        self.cond = threading.Condition()
+        self.thread = None
+
+        # some counters, so we can see how much coalescing saves us:
+        self.queued = 0
+        self.coalesced = 0
+        self.written = 0
+        self.errors = 0
+        self.deferred = 0
+
+        # how long writes wait in the queue, per priority:
+        self.wait_time = [Histogram() for _ in priority_names]
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name='bus-writer', daemon=True)
+        self.thread.start()
+
+    # (call with self.cond held)
+    # returns the write's ticket, for wait_written()
+    def enqueue(self, cmd, value, priority=None):
+        value = int(value)
+        if priority is None:
+            priority = write_priority(cmd, value)
+        self.queued += 1
+        self.tickets += 1
+        if cmd in self.pending_priority:
+            # last value wins, and it moves to the back of the queue,
+            # so eg, DIR then PWM still arrive in the order they were asked for:
+            del self.pending[self.pending_priority[cmd]][cmd]
+            self.coalesced += 1
+        self.pending[priority][cmd] = (value, time.monotonic(), self.tickets)
+        self.pending_priority[cmd] = priority
+        return self.tickets
+
+    def write(self, cmd, value, force=False, priority=None):
+        if force and self.shadow is not None:
+            self.shadow.invalidate(cmd)
+        with self.cond:
+            ticket = self.enqueue(cmd, value, priority)
+            self.cond.notify()
+        return ticket
+
+    # queue a group of writes in one go, so the writer thread sees them all together:
+    # returns the writes' tickets, in the same order:
+    def write_batch(self, writes):
+        with self.cond:
+            tickets = [self.enqueue(cmd, value) for cmd, value in writes]
+            self.cond.notify()
+        return tickets
+
+    def has_pending(self):
+        return any(self.pending)
+
+    # wait till this one write has been dealt with, without waiting on anything else in the queue.
+    # (a register only ever has one write queued, so its writes complete in ticket order,
+    # and a write that was coalesced is done once the newer one is)
+    def wait_written(self, cmd, ticket, timeout=None):
+        with self.cond:
+            return self.cond.wait_for(lambda: self.completed.get(cmd, 0) >= ticket, timeout)
+
+    def flush(self, timeout=None):
+        # wait till everything queued so far has been sent:
+        with self.cond:
+            return self.cond.wait_for(lambda: not self.has_pending() and not self.busy, timeout)
+
+    def stop(self, timeout=1):
+        self.flush(timeout)
+        with self.cond:
+            self.running = False
+            self.cond.notify_all()
+        if self.thread is not None:
+            self.thread.join(timeout)
+            self.thread = None
+
+    def next_write(self):
+        # find the oldest write in the most urgent non-empty queue:
+        for priority, pending in enumerate(self.pending):
+            if pending:
+                cmd = next(iter(pending))
+                value, queued_time, ticket = pending.pop(cmd)
+                del self.pending_priority[cmd]
+                return priority, cmd, value, queued_time, ticket
+
+    def run(self):
+        while True:
+            with self.cond:
+                self.cond.wait_for(lambda: self.has_pending() or not self.running)
+                if not self.has_pending():
+                    return
+                priority, cmd, value, queued_time, ticket = self.next_write()
+                wait = time.monotonic() - queued_time
+                max_wait = self.drop_after.get(priority)
+                if max_wait is not None and wait > max_wait:
+                    # to the back of the idle queue, unless a newer write for cmd replaces it first:
+                    self.deferred += 1
+                    self.pending[PRIORITY_DEFERRED][cmd] = (value, queued_time, ticket)
+                    self.pending_priority[cmd] = PRIORITY_DEFERRED
+                    continue
+                if self.shadow is not None and not self.shadow.needs_write(cmd, value):
+                    self.completed[cmd] = ticket
+                    self.cond.notify_all()
+                    continue
+                self.wait_time[priority].add(wait)
+                self.busy = True
+
+            try:
+                self.bus.write_i2c_block_data(self.address, cmd, [value >> 8, value & 0xff])
+                self.written += 1
+                if self.shadow is not None:
+                    self.shadow.update(cmd, value)
+                time.sleep(self.write_delay)
+            except Exception as e:
+                self.errors += 1
+                # we no longer know what the register holds, so make sure the next write goes through:
+                if self.shadow is not None:
+                    self.shadow.invalidate(cmd)
+                print('bus writer exception: %s' % e)
+
+            with self.cond:
+                self.busy = False
+                self.completed[cmd] = ticket
+                self.cond.notify_all()
+
+    def report(self):
+        lines = ['bus writer: %s queued, %s coalesced, %s deferred, %s written, %s errors' % (
+            self.queued, self.coalesced, self.deferred, self.written, self.errors)]
+        for priority, name in enumerate(priority_names):
+            if self.wait_time[priority].count > 0:
+                lines.append('  %8s queue wait: %s' % (name, self.wait_time[priority].summary()))
+        return '\n'.join(lines)
+
+
+# per register bus statistics:
+class RegisterStats():
+    def __init__(self):
+        self.count = 0
+        self.bytes = 0
+        self.errors = 0
+        self.bus_time = 0
+        self.latency = Histogram()
+
+
+# wraps an smbus.SMBus, and times every transaction, per register.
+# Anything we don't time is passed straight through to the real bus.
+class ProfiledBus():
+    def __init__(self, bus):
+        self.bus = bus
+        self.stats = {}
+        self.start_time = time.monotonic()
+        # reentrant, the SIGUSR1 handler runs report() on the main thread, which may be inside record() already:
+        self.lock = threading.RLock()
+
+    def __getattr__(self, name):
+        return getattr(self.bus, name)
+
+    def record(self, cmd, nbytes, latency, error):
+        with self.lock:
+            if cmd not in self.stats:
+                self.stats[cmd] = RegisterStats()
+            stats = self.stats[cmd]
+            stats.count += 1
+            stats.bytes += nbytes
+            stats.bus_time += latency
+            stats.latency.add(latency)
+            if error:
+                stats.errors += 1
+
+    def write_i2c_block_data(self, address, cmd, vals):
+        start_time = time.perf_counter()
+        try:
+            self.bus.write_i2c_block_data(address, cmd, vals)
+        except Exception:
+            self.record(cmd, len(vals), time.perf_counter() - start_time, True)
+            raise
+        self.record(cmd, len(vals), time.perf_counter() - start_time, False)
+
+    def read_i2c_block_data(self, address, cmd, length=32):
+        start_time = time.perf_counter()
+        try:
+            data = self.bus.read_i2c_block_data(address, cmd, length)
+        except Exception:
+            self.record(cmd, length, time.perf_counter() - start_time, True)
+            raise
+        self.record(cmd, length, time.perf_counter() - start_time, False)
+        return data
+
+    def report(self):
+        with self.lock:
+            elapsed = max(time.monotonic() - self.start_time, 1e-9)
+            total_count = sum(stats.count for stats in self.stats.values())
+            total_time = sum(stats.bus_time for stats in self.stats.values())
+            lines = ['bus profile: %s transactions in %.1fs, %.1f per second, bus busy %.1f%% of the time' % (
+                total_count, elapsed, total_count / elapsed, 100 * total_time / elapsed)]
+            lines.append('%8s %8s %8s %7s %8s %7s  %s' % ('register', 'count', 'bytes', 'errors', 'per sec', 'time %', 'latency'))
+            for cmd in sorted(self.stats):
+                stats = self.stats[cmd]
+                share = 100 * stats.bus_time / total_time if total_time > 0 else 0
+                lines.append('%8s %8s %8s %7s %8.1f %7.1f  %s' % (
+                    register_names.get(cmd, cmd), stats.count, stats.bytes, stats.errors,
+                    stats.count / elapsed, share, stats.latency.summary()))
+        return '\n'.join(lines)
+
+    def dump(self, *args):
+        print(self.report(), flush=True)
+
+    # print the report on kill -USR1, and when we exit:
+    def dump_on_signal(self, signum=signal.SIGUSR1):
+        signal.signal(signum, self.dump)
+        atexit.register(self.dump)
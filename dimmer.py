@@ -1,43 +1,31 @@
 import sys
 import time
 import smbus
+from car_bus import CMD_IO3
+from leds import LedScheduler
 
 if len(sys.argv) < 2:
     pwm_blue = 5
 else:
     pwm_blue = int(sys.argv[1])
 
-CMD_IO1 = 9
-CMD_IO2 = 10
-CMD_IO3 = 11
+smbus_address = 0x18  # default address
+bus = smbus.SMBus(1)
+bus.open(1)
 
 
-def dimmer(pwm, cmd):
-    smbus_address = 0x18  # default address
-    bus = smbus.SMBus(1)
-    bus.open(1)
+def write_reg(cmd, value):
+    bus.write_i2c_block_data(smbus_address, cmd, [value >> 8, value & 0xff])
 
-    start_time = time.time()
-    bus.write_i2c_block_data(smbus_address, CMD_IO1, [0, 0])
-    bus.write_i2c_block_data(smbus_address, CMD_IO1, [0, 1])
-
-    bus.write_i2c_block_data(smbus_address, CMD_IO2, [0, 0])
-    bus.write_i2c_block_data(smbus_address, CMD_IO2, [0, 1])
-
-    bus.write_i2c_block_data(smbus_address, CMD_IO3, [0, 0])
-    bus.write_i2c_block_data(smbus_address, CMD_IO3, [0, 1])
-    end_time = time.time()
-    delta_time = end_time - start_time
-    print(delta_time)
 
+# pwm_blue is out of 10:
+leds = LedScheduler(write_reg)
+leds.set_duty(CMD_IO3, pwm_blue / 10)
+leds.start()
+try:
     while True:
-        if pwm > 0:
-            bus.write_i2c_block_data(smbus_address, cmd, [0, 0])
-        for pwm_counter in range(10):
-            if pwm_counter < pwm:
-                time.sleep(delta_time/6)
-            else:
-                bus.write_i2c_block_data(smbus_address, cmd, [0, 1])
-
-
-dimmer(pwm_blue, CMD_IO3)
+        time.sleep(1)
+except KeyboardInterrupt:
+    leds.close()
+    write_reg(CMD_IO3, 1)
+    print(leds.report())
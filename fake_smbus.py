@@ -0,0 +1,180 @@
+#######################################################################
+# a simulated smbus, that pretends to be the Freenove smart car controller at 0x18
+#
+# drop in replacement for the smbus module, so we can run, test and benchmark the
+# hardware code paths on any linux box, instead of falling back to dummy mode.
+# It keeps the register state, answers CMD_SONIC reads,
+# and sleeps a configurable latency (plus jitter) per bus transaction.
+#
+# Author: Garry Morrison
+# email: garry.morrison _at_ gmail.com
+# Date: 18/10/2026
+# Update: 18/10/2026
+# Copyright: GPLv3
+#
+# Usage:
+#   import fake_smbus as smbus
+#   bus = smbus.SMBus(1)
+#
+#   or, to benchmark the bus writer:
+#   python3 fake_smbus.py [count]
+#
+#   or, to run the GUI against the simulated car:
+#   SMART_CAR_FAKE_SMBUS=1 python3 main_v4.py
+#
+#######################################################################
+
+import random
+import sys
+import threading
+import time
+# the controller's registers:
+from car_bus import CMD_SERVO1, CMD_SERVO2, CMD_SERVO3, CMD_PWM1, CMD_SONIC
+
+device_address = 0x18
+
+# default latency model, in seconds per transaction.
+# roughly what a block write takes on the pi at 100kHz:
+default_latency = 0.0005
+default_jitter = 0.0002
+
+
+class SMBus():
+    def __init__(self, bus=None, latency=None, jitter=None, error_rate=0, distance=50):
+        self.latency = default_latency if latency is None else latency
+        self.jitter = default_jitter if jitter is None else jitter
+        self.error_rate = error_rate  # fraction of transactions that fail, to test error handling
+        self.distance = distance  # pretend obstacle distance, in cm, for CMD_SONIC
+        self.lock = threading.Lock()  # the real bus only does one transaction at a time too
+
+        # register state, as last written:
+        self.registers = {cmd: 0 for cmd in range(CMD_SERVO1, CMD_SONIC + 1)}
+        self.write_time = {}  # cmd -> time.monotonic() of the last write
+        self.transactions = 0
+        self.errors = 0
+        self.bus = bus
+
+    def open(self, bus):
+        self.bus = bus
+
+    def close(self):
+        self.bus = None
+
+    def transaction(self, address):
+        # sleep for our simulated bus time, and maybe fail like the real thing does:
+        delay = self.latency
+        if self.jitter > 0:
+            delay += random.uniform(0, self.jitter)
+        time.sleep(delay)
+        self.transactions += 1
+        if address != device_address:
+            self.errors += 1
+            raise OSError(121, 'Remote I/O error')
+        if self.error_rate > 0 and random.random() < self.error_rate:
+            self.errors += 1
+            raise OSError(121, 'Remote I/O error')
+
+    def sonic_echo_time(self):
+        # the controller returns the echo time in us, and distance = echo_time * 17 / 1000:
+        return int(self.distance * 1000 / 17)
+
+    def write_i2c_block_data(self, address, cmd, vals):
+        with self.lock:
+            self.transaction(address)
+            if cmd not in self.registers:
+                self.errors += 1
+                raise OSError(121, 'Remote I/O error')
+            if cmd == CMD_SONIC:
+                # a write to CMD_SONIC just triggers a new measurement:
+                self.registers[cmd] = self.sonic_echo_time()
+            elif len(vals) >= 2:
+                self.registers[cmd] = (vals[0] << 8) | vals[1]
+            elif len(vals) == 1:
+                self.registers[cmd] = vals[0]
+            self.write_time[cmd] = time.monotonic()
+
+    def read_i2c_block_data(self, address, cmd, length=32):
+        with self.lock:
+            self.transaction(address)
+            if cmd == CMD_SONIC:
+                value = self.sonic_echo_time()
+                data = [value >> 8, value & 0xff]
+            elif cmd == CMD_SONIC + 1:
+                # the Freenove code reads the low byte of the echo time from the next register:
+                data = [self.sonic_echo_time() & 0xff]
+            elif cmd in self.registers:
+                value = self.registers[cmd]
+                data = [value >> 8, value & 0xff]
+            else:
+                self.errors += 1
+                raise OSError(121, 'Remote I/O error')
+            return (data + [0] * length)[:length]
+
+    def write_byte(self, address, value):
+        with self.lock:
+            self.transaction(address)
+
+    def read_byte(self, address):
+        with self.lock:
+            self.transaction(address)
+            return 0
+
+    def write_word_data(self, address, cmd, value):
+        self.write_i2c_block_data(address, cmd, [value >> 8, value & 0xff])
+
+    def read_word_data(self, address, cmd):
+        data = self.read_i2c_block_data(address, cmd, 2)
+        return (data[0] << 8) | data[1]
+
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return 0
+    return values[min(len(values) - 1, int(p / 100 * len(values)))]
+
+
+# measure write throughput, and the latency from write() to the register changing on the car:
+def benchmark(count=1000):
+    from car_bus import BusWriter, ShadowRegisters
+
+    bus = SMBus(1)
+
+    # raw synchronous writes, the way write_reg() used to work:
+    start_time = time.monotonic()
+    for k in range(count):
+        bus.write_i2c_block_data(device_address, CMD_SERVO2, [k >> 8, k & 0xff])
+        time.sleep(0.001)
+    delta_time = time.monotonic() - start_time
+    print('direct writes:    %s writes in %.3fs, %.0f writes/s' % (count, delta_time, count / delta_time))
+
+    # a burst of servo writes through the bus writer, like dragging the camera map:
+    bus_writer = BusWriter(bus, device_address, shadow=ShadowRegisters())
+    bus_writer.start()
+    start_time = time.monotonic()
+    for k in range(count):
+        bus_writer.write(CMD_SERVO2, 500 + k % 2000)
+        bus_writer.write(CMD_SERVO3, 500 + k % 2000)
+    enqueue_time = time.monotonic() - start_time
+    bus_writer.flush()
+    delta_time = time.monotonic() - start_time
+    print('bus writer burst: %s writes queued in %.3fs, on the car after %.3fs, %s actually sent' % (2 * count, enqueue_time, delta_time, bus_writer.written))
+
+    # end to end control latency, one command at a time:
+    latencies = []
+    for k in range(min(count, 200)):
+        value = 1000 + k
+        start_time = time.monotonic()
+        bus_writer.write(CMD_PWM1, value)
+        while bus.registers[CMD_PWM1] != value:
+            time.sleep(0.0001)
+        latencies.append(bus.write_time[CMD_PWM1] - start_time)
+    bus_writer.stop()
+    print('control latency:  p50 %.2fms, p95 %.2fms, p99 %.2fms' % tuple(1000 * percentile(latencies, p) for p in (50, 95, 99)))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) >= 2:
+        benchmark(int(sys.argv[1]))
+    else:
+        benchmark()
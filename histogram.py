@@ -0,0 +1,78 @@
+#######################################################################
+# a small log-bucketed histogram, for latency/timing measurements
+#
+# Memory use is fixed no matter how many samples we add,
+# and the percentiles are good to within a bucket width (about 12% with 20 buckets per decade).
+#
+# Author: Garry Morrison
+# email: garry.morrison _at_ gmail.com
+# Date: 18/10/2026
+# Update: 18/10/2026
+# Copyright: GPLv3
+#
+# Usage:
+#   h = Histogram()
+#   h.add(0.0012)
+#   print(h.summary())
+#
+#######################################################################
+
+import bisect
+
+
+class Histogram():
+    def __init__(self, lo=1e-6, hi=100, buckets_per_decade=20):
+        # bucket upper edges, log spaced from lo to hi (values are in seconds by default):
+        self.edges = []
+        edge = lo
+        step = 10 ** (1 / buckets_per_decade)
+        while edge < hi * step:
+            self.edges.append(edge)
+            edge *= step
+        self.reset()
+
+    def reset(self):
+        self.counts = [0] * (len(self.edges) + 1)  # the last bucket catches everything above hi
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def add(self, value):
+        self.counts[bisect.bisect_left(self.edges, value)] += 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def mean(self):
+        if self.count == 0:
+            return 0
+        return self.total / self.count
+
+    def percentile(self, p):
+        if self.count == 0:
+            return 0
+        rank = p / 100 * self.count
+        running = 0
+        for k, n in enumerate(self.counts):
+            running += n
+            if running >= rank and n > 0:
+                if k == len(self.edges):
+                    return self.max
+                # the bucket's upper edge, but never more than the biggest value we have seen:
+                return min(self.edges[k], self.max)
+        return self.max
+
+    def summary(self, scale=1000, unit='ms'):
+        if self.count == 0:
+            return 'n=0'
+        return 'n=%s mean=%.2f%s p50=%.2f%s p95=%.2f%s p99=%.2f%s max=%.2f%s' % (
+            self.count,
+            scale * self.mean(), unit,
+            scale * self.percentile(50), unit,
+            scale * self.percentile(95), unit,
+            scale * self.percentile(99), unit,
+            scale * self.max, unit)
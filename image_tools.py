@@ -0,0 +1,199 @@
+#######################################################################
+# numpy image code shared by panorama-scan and the image averaging tools
+#
+# image_simm() is the image similarity measure from image-simm.py.
+# SettleDetector uses it to decide when the camera has stopped moving,
+# by comparing consecutive downsampled frames,
+# instead of just sleeping a fixed time after every servo move.
+#
+# FrameAccumulator averages frames as they arrive, by adding each one into a single uint32 sum,
+# so it only ever holds one frame's worth of memory however many frames we average.
+# If asked, it also keeps a per pixel variance, with Welford's running update, in float32.
+#
+# simm_average() is the batch version of averaging only the similar frames of a burst.
+# Rather than comparing frames one at a time against a running mean, which depends on the order they came in,
+# it compares every frame at once against the per pixel median of the burst, on downsampled copies,
+# and then averages the frames that are close enough.
+#
+# Author: Garry Morrison
+# email: garry.morrison _at_ gmail.com
+# Date: 18/10/2026
+# Update: 18/10/2026
+# Copyright: GPLv3
+#
+# Usage:
+#   settle = SettleDetector(threshold=0.97, frames=3, timeout=2)
+#   settled, delta_time, count = settle.wait(get_frame)
+#
+#   acc = FrameAccumulator(variance=True)
+#   for _ in range(count):
+#       acc.add(pygame.surfarray.pixels3d(cam.get_image()))
+#   img = acc.image()
+#   noise = np.sqrt(acc.variance())
+#
+#   frames = np.empty((count, w, h, 3), np.uint8)
+#   img, simm, accepted = simm_average(frames, threshold=0.75)
+#
+#######################################################################
+
+import time
+import numpy as np
+
+
+# returns the image similarity of two images:
+# 1 for exact match,
+# 0 for completely distinct
+# values in between otherwise
+def image_simm(im1, im2):
+    # convert all to float64:
+    fim1 = np.float64(im1)
+    fim2 = np.float64(im2)
+
+    s1 = np.sum(fim1)
+    s2 = np.sum(fim2)
+
+    if s1 == 0 or s2 == 0:
+        return 0
+
+    # wfg = sum(abs(f[k]/s1 - g[k]/s2) for k in range(the_len))
+    wfg = np.sum(np.absolute(fim1 / s1 - fim2 / s2))
+
+    return (2 - wfg) / 2
+
+
+# image_simm() of each of frames, shape (N, ...), against reference, in one go:
+def batch_simm(frames, reference):
+    # always a copy, we work on it in place below:
+    frames = np.array(frames, np.float32)
+    reference = np.asarray(reference, np.float32)
+    axes = tuple(range(1, frames.ndim))
+    s1 = frames.sum(axis=axes, dtype=np.float64)
+    s2 = reference.sum(dtype=np.float64)
+    if s2 == 0:
+        return np.zeros(len(frames))
+
+    # divide our copy in place:
+    frames /= np.float32(np.where(s1 == 0, 1, s1)).reshape((-1,) + (1,) * len(axes))
+    frames -= reference / np.float32(s2)
+    wfg = np.abs(frames, out=frames).sum(axis=axes, dtype=np.float64)
+    return np.where(s1 == 0, 0, (2 - wfg) / 2)
+
+
+# cheap downsample, just keep every factor'th pixel.
+# (this is a view, not a copy)
+def downsample(img, factor=8):
+    return img[::factor, ::factor]
+
+
+# the camera has settled once `frames` consecutive frame pairs are at least `threshold` similar.
+class SettleDetector():
+    def __init__(self, threshold=0.97, frames=3, timeout=2, factor=8):
+        self.threshold = threshold
+        self.frames = frames
+        self.timeout = timeout  # give up after this many seconds
+        self.factor = factor  # downsample factor
+        self.reset()
+
+    def reset(self):
+        self.previous = None
+        self.run = 0  # how many similar pairs in a row
+        self.similarity = 0
+
+    # feed in the next frame, returns True once settled:
+    def update(self, frame):
+        small = np.float64(downsample(frame, self.factor))
+        if self.previous is not None:
+            self.similarity = image_simm(self.previous, small)
+            if self.similarity >= self.threshold:
+                self.run += 1
+            else:
+                self.run = 0
+        self.previous = small
+        return self.run >= self.frames
+
+    # keep grabbing frames till we settle or time out.
+    # returns (settled, seconds taken, frames used)
+    def wait(self, get_frame):
+        self.reset()
+        start_time = time.monotonic()
+        count = 0
+        while True:
+            count += 1
+            if self.update(get_frame()):
+                return True, time.monotonic() - start_time, count
+            if time.monotonic() - start_time > self.timeout:
+                return False, time.monotonic() - start_time, count
+
+
+# running mean (and optionally variance) of uint8 frames, all the same shape.
+# The buffers are made on the first add(), then reused.
+class FrameAccumulator():
+    def __init__(self, variance=False):
+        self.keep_variance = variance
+        self.total = None  # uint32, good for 16 million frames of 255
+        self.running_mean = None  # float32, for the variance
+        self.m2 = None  # float32, sum of squared differences from the mean
+        self.delta = None
+        self.delta2 = None
+        self.count = 0
+
+    def reset(self):
+        self.count = 0
+        if self.total is not None:
+            self.total.fill(0)
+        if self.running_mean is not None:
+            self.running_mean.fill(0)
+            self.m2.fill(0)
+
+    # frame can be a view, eg pygame.surfarray.pixels3d() or a flipped slice, it is not kept:
+    def add(self, frame):
+        if self.total is None:
+            self.total = np.zeros(frame.shape, np.uint32)
+            if self.keep_variance:
+                self.running_mean = np.zeros(frame.shape, np.float32)
+                self.m2 = np.zeros(frame.shape, np.float32)
+                self.delta = np.empty(frame.shape, np.float32)
+                self.delta2 = np.empty(frame.shape, np.float32)
+        elif frame.shape != self.total.shape:
+            raise ValueError('frame shape %s does not match %s' % (frame.shape, self.total.shape))
+        self.count += 1
+        self.total += frame
+        if self.keep_variance:
+            # Welford: mean += (x - mean) / n, m2 += (x - old mean) * (x - new mean)
+            np.subtract(frame, self.running_mean, out=self.delta)
+            np.multiply(self.delta, 1 / self.count, out=self.delta2)
+            self.running_mean += self.delta2
+            np.subtract(frame, self.running_mean, out=self.delta2)
+            self.delta *= self.delta2
+            self.m2 += self.delta
+
+    def mean(self):
+        return np.float32(self.total) / self.count
+
+    # the mean, rounded to the nearest uint8:
+    def image(self):
+        return np.uint8((self.total + self.count // 2) // self.count)
+
+    # per pixel sample variance:
+    def variance(self):
+        if not self.keep_variance:
+            raise ValueError('FrameAccumulator was made without variance=True')
+        return self.m2 / max(self.count - 1, 1)
+
+
+# average the frames, shape (N, ...) uint8, that are at least threshold similar to the median frame.
+# returns (the average as uint8, each frame's similarity, which frames were used)
+def simm_average(frames, threshold=0.75, factor=8):
+    # a view, batch_simm() makes its own float copy of just the pixels we keep:
+    small = frames[:, ::factor, ::factor]
+    reference = np.median(small, axis=0)
+    simm = batch_simm(small, reference)
+    accepted = simm > threshold
+    if not accepted.any():
+        # never come back empty handed, use the most typical frame:
+        accepted[np.argmax(simm)] = True
+
+    acc = FrameAccumulator()
+    for k in np.flatnonzero(accepted):
+        acc.add(frames[k])
+    return acc.image(), simm, accepted
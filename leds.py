@@ -0,0 +1,376 @@
+#######################################################################
+# software PWM for the smart car LED's
+#
+# the old dimmer() ran one process per LED, each with its own smbus, busy looping,
+# and writing to the bus whenever it liked, on top of the GUI's own writes.
+# Now one thread time-multiplexes all three LED channels on a single timeline,
+# sleeping till the next on or off edge, and writes through the same bus writer as everything else.
+#
+# It times every write with a monotonic clock, and wakes up that much early,
+# so each edge lands on time even as the bus gets busier or quieter.
+# set_brightness() goes through a gamma table, so equal slider steps look like equal steps in brightness.
+# report() gives the write latency, and per LED, the frequency and duty cycle we actually got.
+#
+# Patterns are for the LED and buzzer feedback, eg, the startup flash and buzz.
+# A pattern is built from steps, tones, pauses, loops and breathing ramps,
+# and compiled up front into a list of timestamped register writes.
+# PatternPlayer then plays it on its own thread, so nothing has to sleep in the main loop.
+#
+# Author: Garry Morrison
+# email: garry.morrison _at_ gmail.com
+# Date: 18/10/2026
+# Update: 18/10/2026
+# Copyright: GPLv3
+#
+# Usage:
+#   leds = LedScheduler(write_reg)
+#   leds.start()
+#   leds.set_duty(CMD_IO1, 0.4)
+#   leds.set_brightness(CMD_IO2, 0.5)
+#   leds.close()
+#   print(leds.report())
+#
+#   patterns = PatternPlayer(write_reg)
+#   patterns.start()
+#   patterns.play(repeat(sequence(tone(2000, 0.25), pause(0.2)), 2))
+#   patterns.close()
+#
+#######################################################################
+
+import math
+import threading
+import time
+from car_bus import CMD_IO1, CMD_IO2, CMD_IO3, CMD_BUZZER, register_names
+from histogram import Histogram
+
+
+# the LED's are active low:
+LED_ON = 0
+LED_OFF = 1
+
+
+# perceived brightness (0 to 1) -> duty cycle, one entry per level:
+def make_gamma_table(levels=64, gamma=2.2):
+    return [(k / (levels - 1)) ** gamma for k in range(levels)]
+
+
+class LedChannel():
+    def __init__(self, cmd, phase):
+        self.cmd = cmd
+        self.phase = phase  # fraction of a period to offset this channel's on edge, to spread out the bus writes
+        self.duty = 0
+        self.state = None  # last value written, None if we don't know
+        self.cycle_start = None  # time of the current period's on edge
+        self.next_time = None  # time of the next edge, None if there is nothing to do
+        self.next_value = None
+
+        # what we actually got, measured from when each write finished:
+        self.last_on = None  # time of the last on edge
+        self.last_off = None  # time of the last off edge
+        self.periods = Histogram()
+        self.duty_error = Histogram(lo=1e-4, hi=1)
+
+
+class LedScheduler():
+    def __init__(self, write_reg, channels=(CMD_IO1, CMD_IO2, CMD_IO3), frequency=50, levels=64, gamma=2.2):
+        self.write_reg = write_reg
+        self.period = 1 / frequency
+        self.channels = {cmd: LedChannel(cmd, k / len(channels)) for k, cmd in enumerate(channels)}
+        self.gamma_table = make_gamma_table(levels, gamma)
+
+        # running average of how long a write takes, we wake up this much before each edge:
+        self.latency = 0
+        self.write_latency = Histogram()
+        self.running = False
+        self.cond = threading.Condition()
+        self.thread = None
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name='leds', daemon=True)
+        self.thread.start()
+
+    def close(self):
+        with self.cond:
+            self.running = False
+            self.cond.notify_all()
+        if self.thread is not None:
+            self.thread.join(1)
+            self.thread = None
+
+    # duty is 0 for off, 1 for fully on, or anything in between:
+    def set_duty(self, cmd, duty):
+        duty = max(0, min(duty, 1))
+        with self.cond:
+            channel = self.channels[cmd]
+            toggling = 0 < channel.duty < 1
+            channel.duty = duty
+            channel.last_on = None  # start measuring again
+            now = time.monotonic()
+            if duty == 0 or duty == 1:
+                # no PWM needed, just one write:
+                channel.cycle_start = None
+                channel.next_time = now
+                channel.next_value = LED_ON if duty == 1 else LED_OFF
+            elif not toggling:
+                channel.cycle_start = now + channel.phase * self.period
+                channel.next_time = channel.cycle_start
+                channel.next_value = LED_ON
+            elif channel.next_value == LED_OFF:
+                # already mid period, so move this period's off edge:
+                channel.next_time = channel.cycle_start + duty * self.period
+            self.cond.notify()
+
+    # brightness is 0 to 1, as it looks to us, not as a duty cycle:
+    def set_brightness(self, cmd, brightness):
+        brightness = max(0, min(brightness, 1))
+        self.set_duty(cmd, self.gamma_table[round(brightness * (len(self.gamma_table) - 1))])
+
+    def set_led(self, cmd, on):
+        self.set_duty(cmd, 1 if on else 0)
+
+    # called without self.cond held, so set_duty() never waits on the bus:
+    def write(self, channel, value):
+        start_time = time.monotonic()
+        self.write_reg(channel.cmd, value)
+        end_time = time.monotonic()
+
+        latency = end_time - start_time
+        with self.cond:
+            self.write_latency.add(latency)
+            self.latency += 0.1 * (latency - self.latency)
+            self.measure(channel, value, end_time)
+
+    # compare the period and duty cycle we got against what we wanted:
+    def measure(self, channel, value, now):
+        if value == LED_OFF:
+            channel.last_off = now
+            return
+        if channel.last_on is not None and channel.last_off is not None and channel.last_off > channel.last_on:
+            period = now - channel.last_on
+            channel.periods.add(period)
+            channel.duty_error.add(abs((channel.last_off - channel.last_on) / period - channel.duty))
+        channel.last_on = now
+
+    # take the edge that is due, and work out the channel's next one.
+    # returns the value to write, or None if the LED is already there:
+    def fire(self, channel, now):
+        value = channel.next_value
+        if channel.cycle_start is None:
+            channel.next_time = None
+        elif channel.next_value == LED_ON:
+            channel.next_time = channel.cycle_start + channel.duty * self.period
+            channel.next_value = LED_OFF
+        else:
+            channel.cycle_start += self.period
+            if channel.cycle_start < now:
+                # we have fallen behind, so start again from now rather than trying to catch up:
+                channel.cycle_start = now
+            channel.next_time = channel.cycle_start
+            channel.next_value = LED_ON
+        if channel.state == value:
+            return None
+        channel.state = value
+        return value
+
+    def run(self):
+        while True:
+            with self.cond:
+                if not self.running:
+                    return
+                pending = [channel for channel in self.channels.values() if channel.next_time is not None]
+                if not pending:
+                    self.cond.wait()
+                    continue
+                channel = min(pending, key=lambda c: c.next_time)
+                now = time.monotonic()
+                # start the write early enough that it lands on the edge, but never by more than half a period:
+                lead = min(self.latency, self.period / 2)
+                if channel.next_time - lead > now:
+                    # sleep till the next edge, or till set_duty() changes things:
+                    self.cond.wait(channel.next_time - lead - now)
+                    continue
+                value = self.fire(channel, now)
+            # the bus write itself is done without the lock:
+            if value is not None:
+                self.write(channel, value)
+
+    def report(self):
+        with self.cond:
+            lines = ['leds: %.0fHz target, write latency: %s' % (1 / self.period, self.write_latency.summary())]
+            for channel in self.channels.values():
+                if channel.periods.count > 0:
+                    lines.append('  %s: duty %.3f, achieved %.1fHz, duty error: %s' % (
+                        register_names.get(channel.cmd, channel.cmd), channel.duty, 1 / channel.periods.mean(),
+                        channel.duty_error.summary(scale=100, unit='%')))
+            return '\n'.join(lines)
+
+
+# a compiled pattern, the list of (seconds from the start, cmd, value) writes, and how long it lasts:
+class Pattern():
+    def __init__(self, events=(), length=0):
+        self.events = sorted(events, key=lambda event: event[0])  # stable, so writes at the same time keep their order
+        self.length = length
+
+    # what each register is left at, once the pattern is done:
+    def end_state(self):
+        return {cmd: value for _, cmd, value in self.events}
+
+
+# write these registers, then hold for duration:
+def step(writes, duration=0):
+    return Pattern([(0, cmd, value) for cmd, value in writes.items()], duration)
+
+
+def pause(duration):
+    return Pattern([], duration)
+
+
+def tone(frequency, duration):
+    return Pattern([(0, CMD_BUZZER, frequency), (duration, CMD_BUZZER, 0)], duration)
+
+
+# True for on, False for off, None to leave that LED alone:
+def lights(red=None, green=None, blue=None, duration=0):
+    writes = {}
+    for cmd, on in ((CMD_IO1, red), (CMD_IO2, green), (CMD_IO3, blue)):
+        if on is not None:
+            writes[cmd] = LED_ON if on else LED_OFF
+    return step(writes, duration)
+
+
+# one after the other:
+def sequence(*patterns):
+    events = []
+    offset = 0
+    for pattern in patterns:
+        events.extend((offset + t, cmd, value) for t, cmd, value in pattern.events)
+        offset += pattern.length
+    return Pattern(events, offset)
+
+
+# all at the same time:
+def together(*patterns):
+    events = []
+    for pattern in patterns:
+        events.extend(pattern.events)
+    return Pattern(events, max((pattern.length for pattern in patterns), default=0))
+
+
+def repeat(pattern, count):
+    return sequence(*[pattern] * count)
+
+
+# fade an LED up and down, period seconds per breath, as software PWM edges at frequency Hz:
+def breathe(cmd, duration, period=2, frequency=50, gamma=2.2):
+    events = []
+    cycle = 1 / frequency
+    for k in range(int(duration * frequency)):
+        t = k * cycle
+        duty = ((1 - math.cos(2 * math.pi * t / period)) / 2) ** gamma
+        if duty * cycle < 0.001:
+            # too short to be worth a pair of bus writes:
+            events.append((t, cmd, LED_OFF))
+        elif duty > 0.95:
+            events.append((t, cmd, LED_ON))
+        else:
+            events.append((t, cmd, LED_ON))
+            events.append((t + duty * cycle, cmd, LED_OFF))
+    events.append((duration, cmd, LED_OFF))
+    return Pattern(events, duration)
+
+
+# plays one pattern at a time, a new play() replaces whatever is playing.
+# stop() (or close()) skips straight to the end, so we never leave the buzzer going.
+class PatternPlayer():
+    def __init__(self, write_reg):
+        self.write_reg = write_reg
+        self.pattern = None
+        self.start_time = None
+        self.position = 0  # index of the next event to write
+        self.then = None  # called once the pattern is done
+        self.running = False
+        self.cond = threading.Condition()
+        self.thread = None
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name='patterns', daemon=True)
+        self.thread.start()
+
+    def close(self):
+        self.stop()
+        with self.cond:
+            self.running = False
+            self.cond.notify_all()
+        if self.thread is not None:
+            self.thread.join(1)
+            self.thread = None
+
+    def play(self, pattern, then=None):
+        with self.cond:
+            self.finish()
+            self.pattern = pattern
+            self.start_time = time.monotonic()
+            self.position = 0
+            self.then = then
+            self.cond.notify_all()
+
+    def stop(self):
+        with self.cond:
+            self.finish()
+
+    def playing(self):
+        return self.pattern is not None
+
+    # wait till the current pattern is done:
+    def wait(self, timeout=None):
+        with self.cond:
+            return self.cond.wait_for(lambda: not self.playing(), timeout)
+
+    # write the end state of anything still to come, and tidy up:
+    def finish(self):
+        if self.pattern is None:
+            return
+        for cmd, value in Pattern(self.pattern.events[self.position:]).end_state().items():
+            self.write(cmd, value)
+        self.done()
+
+    def done(self):
+        then = self.then
+        self.pattern = None
+        self.then = None
+        if then is not None:
+            try:
+                then()
+            except Exception as e:
+                print('pattern exception: %s' % e)
+        self.cond.notify_all()
+
+    def write(self, cmd, value):
+        try:
+            self.write_reg(cmd, value)
+        except Exception as e:
+            print('pattern exception: %s' % e)
+
+    def run(self):
+        with self.cond:
+            while self.running:
+                if self.pattern is None:
+                    self.cond.wait()
+                    continue
+                now = time.monotonic() - self.start_time
+                events = self.pattern.events
+                while self.position < len(events) and events[self.position][0] <= now:
+                    _, cmd, value = events[self.position]
+                    self.write(cmd, value)
+                    self.position += 1
+                if self.position < len(events):
+                    next_time = events[self.position][0]
+                elif now < self.pattern.length:
+                    next_time = self.pattern.length
+                else:
+                    self.done()
+                    continue
+                # sleep till the next write, or till play() or stop() changes things:
+                self.cond.wait(next_time - now)
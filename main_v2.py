@@ -20,8 +20,8 @@
 import pygame
 import sys
 import time
-# from multiprocessing import Process, Value
-import multiprocessing as mp
+from car_bus import BusWriter, ShadowRegisters
+from leds import LedScheduler
 
 # try to set up smbus:
 # (this will only work on the raspberry pi, so if it fails we drop back to dummy mode)
@@ -106,15 +106,25 @@ def num_map(value, fromLow, fromHigh, toLow, toHigh):
     return (toHigh-toLow)*(value-fromLow) / (fromHigh-fromLow) + toLow
 
 
+# writes are queued, and sent by the bus writer thread, so the GUI never waits on the bus:
 def write_reg(cmd, value):
     try:
-        value = int(value)
-        bus.write_i2c_block_data(smbus_address, cmd, [value >> 8, value & 0xff])
-        time.sleep(0.001)
+        bus_writer.write(cmd, value)
     except Exception as e:
         print('write_reg exception: %s' % e)
 
 
+# the LED scheduler times its writes, so wait till this one has actually gone out on the bus,
+# that way it measures the real round trip, and not just the time to queue it.
+# (only this write, waiting for the whole queue would count unrelated servo and motor writes too)
+def write_led(cmd, value):
+    try:
+        ticket = bus_writer.write(cmd, value)
+        bus_writer.wait_written(cmd, ticket, 0.02)
+    except Exception as e:
+        print('write_led exception: %s' % e)
+
+
 def write_servo(cmd, value):
     try:
         # value = int(num_map(value, 0, 180, 500, 2500))
@@ -262,13 +272,13 @@ def red_pressed(me):
     if is_red:
         if have_smbus:
             # write_reg(CMD_IO1, 0)
-            dim_red.value = int(pwm_red.val)
+            leds.set_brightness(CMD_IO1, pwm_red.val / 100)
         # return RED
         me.color = RED
     else:
         if have_smbus:
             # write_reg(CMD_IO1, 1)
-            dim_red.value = 0
+            leds.set_duty(CMD_IO1, 0)
         me.color = GREY2
 
 
@@ -283,13 +293,13 @@ def green_pressed(me):
     if is_green:
         if have_smbus:
             # write_reg(CMD_IO2, 0)
-            dim_green.value = int(pwm_green.val)
+            leds.set_brightness(CMD_IO2, pwm_green.val / 100)
         # return GREEN
         me.color = GREEN
     else:
         if have_smbus:
             # write_reg(CMD_IO2, 1)
-            dim_green.value = 0
+            leds.set_duty(CMD_IO2, 0)
         me.color = GREY2
 
 def green_released(me):
@@ -303,13 +313,13 @@ def blue_pressed(me):
     if is_blue:
         if have_smbus:
             # write_reg(CMD_IO3, 0)
-            dim_blue.value = int(pwm_blue.val)
+            leds.set_brightness(CMD_IO3, pwm_blue.val / 100)
         # return BLUE
         me.color = BLUE
     else:
         if have_smbus:
             # write_reg(CMD_IO3, 1)
-            dim_blue.value = 0
+            leds.set_duty(CMD_IO3, 0)
         me.color = GREY2
 
 
@@ -626,56 +636,25 @@ def current_angle_moved(val):
 def red_pwm_moved(val):
     if have_smbus:
         if is_red:
-            dim_red.value = int(val)
+            leds.set_brightness(CMD_IO1, val / 100)
         else:
-            dim_red.value = 0
+            leds.set_duty(CMD_IO1, 0)
 
 
 def green_pwm_moved(val):
     if have_smbus:
         if is_green:
-            dim_green.value = int(val)
+            leds.set_brightness(CMD_IO2, val / 100)
         else:
-            dim_green.value = 0
+            leds.set_duty(CMD_IO2, 0)
 
 
 def blue_pwm_moved(val):
     if have_smbus:
         if is_blue:
-            dim_blue.value = int(val)
+            leds.set_brightness(CMD_IO3, val / 100)
         else:
-            dim_blue.value = 0
-
-
-def dimmer(n, cmd):
-    smbus_address = 0x18  # default address
-    bus = smbus.SMBus(1)
-    bus.open(1)
-
-    start_time = time.time()
-    bus.write_i2c_block_data(smbus_address, CMD_IO1, [0, 0])
-    bus.write_i2c_block_data(smbus_address, CMD_IO1, [0, 1])
-
-    bus.write_i2c_block_data(smbus_address, CMD_IO2, [0, 0])
-    bus.write_i2c_block_data(smbus_address, CMD_IO2, [0, 1])
-
-    bus.write_i2c_block_data(smbus_address, CMD_IO3, [0, 0])
-    bus.write_i2c_block_data(smbus_address, CMD_IO3, [0, 1])
-    end_time = time.time()
-    delta_time = end_time - start_time
-    print(delta_time)
-
-    while True:
-        pwm = n.value
-        if pwm == -1:
-            return
-        if pwm > 0:
-            bus.write_i2c_block_data(smbus_address, cmd, [0, 0])
-        for pwm_counter in range(5):
-            if pwm_counter < pwm:
-                time.sleep(delta_time/6)
-            else:
-                bus.write_i2c_block_data(smbus_address, cmd, [0, 1])
+            leds.set_duty(CMD_IO3, 0)
 
 
 def mousebuttondown():
@@ -725,6 +704,10 @@ if __name__ == '__main__':
 
     # initialize the car:
     if have_smbus:
+        # start the bus writer thread, the GUI and the LED dimmers share it:
+        bus_writer = BusWriter(bus, smbus_address, shadow=ShadowRegisters())
+        bus_writer.start()
+
         # set servo's to initial state:
         # write_reg(CMD_SERVO1, num_map(state_servo_1, 0, 180, 500, 2500))
         # write_reg(CMD_SERVO2, num_map(state_servo_2, 0, 180, 500, 2500))
@@ -756,45 +739,36 @@ if __name__ == '__main__':
             write_reg(CMD_BUZZER, 0)
             time.sleep(0.2)
 
-        # initialize the LED dimmer's:
-        dim_red = mp.Value('i', 5)
-        p_red = mp.Process(target=dimmer, args=(dim_red, CMD_IO1))
-        p_red.start()
-
-        dim_green = mp.Value('i', 5)
-        p_green = mp.Process(target=dimmer, args=(dim_green, CMD_IO2))
-        p_green.start()
-
-        dim_blue = mp.Value('i', 5)
-        p_blue = mp.Process(target=dimmer, args=(dim_blue, CMD_IO3))
-        p_blue.start()
+        # initialize the LED dimmer's, one scheduler for all three:
+        leds = LedScheduler(write_led)
+        leds.start()
 
         # set LED's:
         if is_red:
             # write_reg(CMD_IO1, 0)
-            dim_red.value = 5
+            leds.set_duty(CMD_IO1, 1)
             button_red_color = RED
         else:
             # write_reg(CMD_IO1, 1)
-            dim_red.value = 0
+            leds.set_duty(CMD_IO1, 0)
             button_red_color = GREY2
 
         if is_green:
             # write_reg(CMD_IO2, 0)
-            dim_green.value = 5
+            leds.set_duty(CMD_IO2, 1)
             button_green_color = GREEN
         else:
             # write_reg(CMD_IO2, 1)
-            dim_green.value = 0
+            leds.set_duty(CMD_IO2, 0)
             button_green_color = GREY2
 
         if is_blue:
             # write_reg(CMD_IO3, 0)
-            dim_blue.value = 5
+            leds.set_duty(CMD_IO3, 1)
             button_blue_color = BLUE
         else:
             # write_reg(CMD_IO3, 1)
-            dim_blue.value = 0
+            leds.set_duty(CMD_IO3, 0)
             button_blue_color = GREY2
 
     # insert smart car border:
@@ -863,17 +837,17 @@ if __name__ == '__main__':
     # red pwm:
     text_surf = font.render('Red', 1, BLACK)
     screen.blit(text_surf, (260, 425))
-    pwm_red = Slider("pwm red", 5, 5, 0, 340, 425, action=red_pwm_moved)
+    pwm_red = Slider("pwm red", 100, 100, 0, 340, 425, action=red_pwm_moved)
 
     # green pwm:
     text_surf = font.render('Green', 1, BLACK)
     screen.blit(text_surf, (247, 465))
-    pwm_green = Slider("pwm green", 5, 5, 0, 340, 465, action=green_pwm_moved)
+    pwm_green = Slider("pwm green", 100, 100, 0, 340, 465, action=green_pwm_moved)
 
     # blue pwm:
     text_surf = font.render('Blue', 1, BLACK)
     screen.blit(text_surf, (255, 505))
-    pwm_blue = Slider("pwm blue", 5, 5, 0, 340, 505, action=blue_pwm_moved)
+    pwm_blue = Slider("pwm blue", 100, 100, 0, 340, 505, action=blue_pwm_moved)
 
 
     # camera horizontal angle:
@@ -937,20 +911,17 @@ if __name__ == '__main__':
         for event in pygame.event.get():
             if event.type == pygame.QUIT:
                 if have_smbus:
-                    # switch off dimmer processes:
-                    dim_red.value = -1
-                    p_red.join()
-
-                    dim_green.value = -1
-                    p_green.join()
-
-                    dim_blue.value = -1
-                    p_blue.join()
+                    # switch off the LED scheduler:
+                    leds.close()
+                    print(leds.report())
 
                     # switch off LED's:
                     write_reg(CMD_IO1, 1)
                     write_reg(CMD_IO2, 1)
                     write_reg(CMD_IO3, 1)
+
+                    # make sure everything queued actually reaches the car:
+                    bus_writer.stop()
                 if have_camera:
                     cam.stop()
                 pygame.quit()
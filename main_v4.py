@@ -18,11 +18,21 @@
 #######################################################################
 
 import pygame
+import os
 import sys
 import time
+from car_bus import BusWriter, ShadowRegisters, ProfiledBus
+from car_bus import CMD_SERVO1, CMD_SERVO2, CMD_SERVO3, CMD_SERVO4, CMD_PWM1, CMD_PWM2, CMD_BUZZER, CMD_IO1, CMD_IO2, CMD_IO3
+from motion import MotionController, FORWARD, BACKWARD
+from watchdog import Watchdog
+from servo import ServoMotion, ServoCalibration
+from leds import PatternPlayer, step, sequence, repeat
+from recorder import Recorder, FrameRing, Snapshots
+from camera import CaptureThread, FramePipeline, FrameStats, PreviewScheduler, camera_flip, open_camera
 
 # try to set up smbus:
 # (this will only work on the raspberry pi, so if it fails we drop back to dummy mode)
+# (or set SMART_CAR_FAKE_SMBUS=1 to use the simulated car in fake_smbus.py instead)
 try:
     import smbus
     smbus_address = 0x18  # default address
@@ -30,22 +40,53 @@ try:
     bus.open(1)
     have_smbus = True
 except ImportError:
-    print('failed to import smbus, dummy mode on')
-    have_smbus = False
+    if os.environ.get('SMART_CAR_FAKE_SMBUS'):
+        print('failed to import smbus, using simulated smbus')
+        import fake_smbus as smbus
+        smbus_address = 0x18  # default address
+        bus = smbus.SMBus(1)
+        have_smbus = True
+    else:
+        print('failed to import smbus, dummy mode on')
+        have_smbus = False
+
+# optionally profile the bus (press 'p' or kill -USR1 to see the report, it also prints on exit):
+bus_profiler = None
+if have_smbus and os.environ.get('SMART_CAR_PROFILE_BUS'):
+    bus = bus_profiler = ProfiledBus(bus)
+    bus_profiler.dump_on_signal()
 
 pygame.init()
 
+# load the servo calibration:
+calibration = ServoCalibration()
+
 # set the desired image/camera size here, and the buttons/sliders will auto adjust to the right positions
 # camera_size = (320, 240)
 camera_size = (640, 480)
-# camera_size = (800, 600)               # works with my new camera, but is slow to update, and makes the GUI slow too.
+# camera_size = (800, 600)               # works with my new camera, the preview just updates less often (see preview_budget)
 cx = camera_size[0]
 cy = camera_size[1]
 
-# update the image every 25 main event loops:
-# we are trying to make the GUI more responsive
-# another option is threading, but that depends on if the slow speed is the camera or VNC.
-camera_frequency = 25
+# the camera captures at this size, the preview is shrunk to camera_size, and snapshots are full size:
+# capture_size = camera_size
+capture_size = (1024, 768)
+
+# stop the motors if the main loop doesn't come back around within this many seconds:
+watchdog_deadline = 0.25
+
+# handle input at least this often, in seconds, the camera preview rate adapts to fit:
+preview_budget = 0.05
+
+# keep this many seconds of camera frames, to dump with 'd', kill -USR2, or when the watchdog fires while driving:
+replay_seconds = 10
+# at most one watchdog dump per this many seconds, each one is a few hundred MB:
+replay_interval = 60
+# the ring itself lives in RAM, if we can, so it isn't written back to the SD card all the time:
+replay_ring_directory = '/dev/shm' if os.path.isdir('/dev/shm') else 'recordings'
+
+# max speed of the camera servos, in degrees per second:
+camera_servo_velocity = 180
 
 # cam.set_controls(hflip = True, vflip = False)
 # camera controls:
@@ -55,25 +96,18 @@ vflip = True
 
 # try to set up the camera:
 # (again, this will only work on the raspberry pi, so if it fails we drop back to a static image)
-try:
-    import pygame.camera
-    pygame.camera.init()
-    camera_list = pygame.camera.list_cameras()
-    if not camera_list:
-        have_camera = False
-    else:
-        # cam = pygame.camera.Camera(camera_list[0], (320, 240))
-        cam = pygame.camera.Camera(camera_list[0], camera_size)
-        cam.start()
-        cs = cam.get_size()
-        print('camera size: %s' % str(cs))
-        # cam.set_controls(hflip, vflip)
-        # print('controls', cam.get_controls())
-        # cam.set_controls(hflip=hflip, vflip=vflip) # nope, bugs out in python 3.
-        have_camera = True
-except ImportError:
+# (or set SMART_CAR_CAMERA=synthetic, or replay:<directory>, to try the GUI without one, see camera.py)
+cam = open_camera(capture_size)
+have_camera = cam is not None
+if have_camera:
+    cam.start()
+    cs = cam.get_size()
+    print('camera size: %s' % str(cs))
+    # let the camera do the flipping if it can, hflip and vflip are then what is left for us to do:
+    # (cam.set_controls(hflip=hflip, vflip=vflip) used to bug out in python 3, camera_flip() checks it took)
+    hflip, vflip = camera_flip(cam, hflip, vflip)
+else:
     print('failed to find a camera')
-    have_camera = False
 
 
 # define some colours:
@@ -103,23 +137,6 @@ display_height = 560 - 240 + cy
 
 background_color = WHITE
 
-# define IO constants:
-CMD_SERVO1 = 0
-CMD_SERVO2 = 1
-CMD_SERVO3 = 2
-CMD_SERVO4 = 3
-CMD_PWM1 = 4
-CMD_PWM2 = 5
-CMD_DIR1 = 6
-CMD_DIR2 = 7
-CMD_BUZZER = 8
-CMD_IO1 = 9
-CMD_IO2 = 10
-CMD_IO3 = 11
-CMD_SONIC = 12
-SERVO_MAX_PULSE_WIDTH = 2500
-SERVO_MIN_PULSE_WIDTH = 500
-
 
 def constrain(val, min_val, max_val):
     val = max(val, min_val)
@@ -131,21 +148,23 @@ def num_map(value, fromLow, fromHigh, toLow, toHigh):
     return (toHigh-toLow)*(value-fromLow) / (fromHigh-fromLow) + toLow
 
 
-def write_reg(cmd, value):
+# writes are queued, and sent by the bus writer thread, so the GUI never waits on the bus:
+# (writes that don't change a register are skipped, unless force is set)
+def write_reg(cmd, value, force=False):
     try:
-        value = int(value)
-        bus.write_i2c_block_data(smbus_address, cmd, [value >> 8, value & 0xff])
-        time.sleep(0.001)
+        bus_writer.write(cmd, value, force)
     except Exception as e:
         print('write_reg exception: %s' % e)
 
 
+# the servo calibration (pulse widths, trim, inverted or not) is looked up in a precomputed table:
+def steering_pulse(angle):
+    return calibration.pulse(CMD_SERVO1, angle)
+
+
 def write_servo(cmd, value):
     try:
-        # value = int(num_map(value, 0, 180, 500, 2500))
-        value = constrain(value, 0, 180)
-        value = int(num_map(value, 0, 180, SERVO_MIN_PULSE_WIDTH, SERVO_MAX_PULSE_WIDTH))
-        write_reg(cmd, value)
+        write_reg(cmd, calibration.pulse(cmd, value))
     except Exception as e:
         print('write_servo exception: %s' % e)
 
@@ -402,6 +421,7 @@ def blue_released():
 def buzzer_pressed():
     print('buzzer %s!' % int(buzzer_freq.val), flush=True)
     if have_smbus:
+        patterns.stop()
         write_reg(CMD_BUZZER, buzzer_freq.val)
 
 
@@ -411,208 +431,122 @@ def buzzer_released():
         write_reg(CMD_BUZZER, 0)
 
 
-def forward_pressed():
-    print('forward', str(int(10 * speed.val)), flush=True)
-    if have_smbus:
-        write_reg(CMD_DIR1, 1)
-        write_reg(CMD_DIR2, 1)
+# set the LED's to match the red, green and blue buttons, eg, once the startup pattern is done:
+def show_leds():
+    write_reg(CMD_IO1, 0 if is_red else 1)
+    write_reg(CMD_IO2, 0 if is_green else 1)
+    write_reg(CMD_IO3, 0 if is_blue else 1)
 
-        write_reg(CMD_PWM1, speed.val * 10 / 3)
-        write_reg(CMD_PWM2, speed.val * 10 / 3)
-        time.sleep(0.07)
 
-        write_reg(CMD_PWM1, speed.val * 20 / 3)
-        write_reg(CMD_PWM2, speed.val * 20 / 3)
-        time.sleep(0.07)
+# save the newest full size camera frame, the saving happens in the background:
+def snapshot_pressed():
+    print('snapshot!', flush=True)
+    if have_camera:
+        with capture.lock:
+            if capture.front is not None:
+                snapshots.take(capture.front)
 
-        write_reg(CMD_PWM1, speed.val * 10)
-        write_reg(CMD_PWM2, speed.val * 10)
 
-def forward_released():
+def snapshot_released():
+    pass
+
+
+# all the driving buttons go through motion.drive(), which only writes the registers that change.
+# turn is +1 for left, -1 for right, 0 for straight ahead:
+def drive_pressed(name, direction, turn=0):
+    print(name, str(int(10 * speed.val)), flush=True)
+    global state_servo_1
+    steer = None
+    if turn != 0:
+        state_servo_1 = current_angle.val + turn * turning_angle.val
+        state_servo_1 = constrain(state_servo_1, 0, 180)
+        current_angle.val = 180 - state_servo_1
+        steer = state_servo_1
+    if have_smbus:
+        # soft start, the ramp runs on the motion thread:
+        motion.drive(direction, speed.val * 10, steer)
+
+def drive_released(straighten=False):
     print('stop!', flush=True)
+    steer = None
+    if straighten:
+        current_angle.val = 90
+        steer = 90
     if have_smbus:
-        write_reg(CMD_PWM1, 0)
-        write_reg(CMD_PWM2, 0)
+        motion.drive(speed=0, steer=steer)
 
-def backward_pressed():
-    print('backward', str(int(10 * speed.val)), flush=True)
+def steer_pressed(name, turn):
+    print(name, flush=True)
+    global state_servo_1
+    state_servo_1 += turn * turning_angle.val
+    state_servo_1 = constrain(state_servo_1, 0, 180)
+    current_angle.val = 180 - state_servo_1
     if have_smbus:
-        write_reg(CMD_DIR1, 0)
-        write_reg(CMD_DIR2, 0)
+        motion.drive(steer=state_servo_1)
 
-        write_reg(CMD_PWM1, speed.val * 10 / 3)
-        write_reg(CMD_PWM2, speed.val * 10 / 3)
-        time.sleep(0.07)
+def forward_pressed():
+    drive_pressed('forward', FORWARD)
 
-        write_reg(CMD_PWM1, speed.val * 20 / 3)
-        write_reg(CMD_PWM2, speed.val * 20 / 3)
-        time.sleep(0.07)
+def forward_released():
+    drive_released()
 
-        write_reg(CMD_PWM1, speed.val * 10)
-        write_reg(CMD_PWM2, speed.val * 10)
+def backward_pressed():
+    drive_pressed('backward', BACKWARD)
 
 def backward_released():
-    print('stop!', flush=True)
-    if have_smbus:
-        write_reg(CMD_PWM1, 0)
-        write_reg(CMD_PWM2, 0)
+    drive_released()
 
 def left_pressed():
-    print('left', flush=True)
-    global state_servo_1
-    state_servo_1 += turning_angle.val
-    state_servo_1 = constrain(state_servo_1, 0, 180)
-    current_angle.val = 180 - state_servo_1
-    if have_smbus:
-        # write_reg(CMD_SERVO1, num_map(state_servo_1, 0, 180, 500, 2500))
-        write_servo(CMD_SERVO1, state_servo_1 + fine_servo_1.val)
+    steer_pressed('left', 1)
 
 def left_released():
     pass
 
 def right_pressed():
-    print('right', flush=True)
-    global state_servo_1
-    state_servo_1 -= turning_angle.val
-    state_servo_1 = constrain(state_servo_1, 0, 180)
-    current_angle.val = 180 - state_servo_1
-    if have_smbus:
-        # write_reg(CMD_SERVO1, num_map(state_servo_1, 0, 180, 500, 2500))
-        write_servo(CMD_SERVO1, state_servo_1 + fine_servo_1.val)
+    steer_pressed('right', -1)
 
 def right_released():
     pass
 
 
 def forward_left_pressed():
-    print('forward left', str(int(10 * speed.val)), flush=True)
-    if have_smbus:
-        write_reg(CMD_DIR1, 1)
-        write_reg(CMD_DIR2, 1)
-
-        write_reg(CMD_PWM1, speed.val * 10 / 3)
-        write_reg(CMD_PWM2, speed.val * 10 / 3)
-        time.sleep(0.07)
-
-        write_reg(CMD_PWM1, speed.val * 20 / 3)
-        write_reg(CMD_PWM2, speed.val * 20 / 3)
-        time.sleep(0.07)
-
-        write_reg(CMD_PWM1, speed.val * 10)
-        write_reg(CMD_PWM2, speed.val * 10)
-
-    global state_servo_1
-    state_servo_1 = current_angle.val + turning_angle.val
-    state_servo_1 = constrain(state_servo_1, 0, 180)
-    current_angle.val = 180 - state_servo_1
-    if have_smbus:
-        write_servo(CMD_SERVO1, state_servo_1 + fine_servo_1.val)
+    drive_pressed('forward left', FORWARD, 1)
 
 def forward_left_released():
-    print('stop!', flush=True)
-    current_angle.val = 90
-    if have_smbus:
-        write_reg(CMD_PWM1, 0)
-        write_reg(CMD_PWM2, 0)
-        write_servo(CMD_SERVO1, 90 + fine_servo_1.val)
+    drive_released(straighten=True)
 
 def forward_right_pressed():
-    print('forward right', str(int(10 * speed.val)), flush=True)
-    if have_smbus:
-        write_reg(CMD_DIR1, 1)
-        write_reg(CMD_DIR2, 1)
-
-        write_reg(CMD_PWM1, speed.val * 10 / 3)
-        write_reg(CMD_PWM2, speed.val * 10 / 3)
-        time.sleep(0.07)
-
-        write_reg(CMD_PWM1, speed.val * 20 / 3)
-        write_reg(CMD_PWM2, speed.val * 20 / 3)
-        time.sleep(0.07)
-
-        write_reg(CMD_PWM1, speed.val * 10)
-        write_reg(CMD_PWM2, speed.val * 10)
-
-    global state_servo_1
-    state_servo_1 = current_angle.val - turning_angle.val
-    state_servo_1 = constrain(state_servo_1, 0, 180)
-    current_angle.val = 180 - state_servo_1
-    if have_smbus:
-        write_servo(CMD_SERVO1, state_servo_1 + fine_servo_1.val)
+    drive_pressed('forward right', FORWARD, -1)
 
 def forward_right_released():
-    print('stop!', flush=True)
-    current_angle.val = 90
-    if have_smbus:
-        write_reg(CMD_PWM1, 0)
-        write_reg(CMD_PWM2, 0)
-        write_servo(CMD_SERVO1, 90 + fine_servo_1.val)
+    drive_released(straighten=True)
 
 def backward_left_pressed():
-    print('backward left', str(int(10 * speed.val)), flush=True)
-    if have_smbus:
-        write_reg(CMD_DIR1, 0)
-        write_reg(CMD_DIR2, 0)
-
-        write_reg(CMD_PWM1, speed.val * 10 / 3)
-        write_reg(CMD_PWM2, speed.val * 10 / 3)
-        time.sleep(0.07)
-
-        write_reg(CMD_PWM1, speed.val * 20 / 3)
-        write_reg(CMD_PWM2, speed.val * 20 / 3)
-        time.sleep(0.07)
-
-        write_reg(CMD_PWM1, speed.val * 10)
-        write_reg(CMD_PWM2, speed.val * 10)
-
-    global state_servo_1
-    state_servo_1 = current_angle.val + turning_angle.val
-    state_servo_1 = constrain(state_servo_1, 0, 180)
-    current_angle.val = 180 - state_servo_1
-    if have_smbus:
-        write_servo(CMD_SERVO1, state_servo_1 + fine_servo_1.val)
+    drive_pressed('backward left', BACKWARD, 1)
 
 def backward_left_released():
-    print('stop!', flush=True)
-    current_angle.val = 90
-    # current_angle.draw()
-    if have_smbus:
-        write_reg(CMD_PWM1, 0)
-        write_reg(CMD_PWM2, 0)
-        write_servo(CMD_SERVO1, 90 + fine_servo_1.val)
+    drive_released(straighten=True)
 
 def backward_right_pressed():
-    print('backward right', str(int(10 * speed.val)), flush=True)
-    if have_smbus:
-        write_reg(CMD_DIR1, 0)
-        write_reg(CMD_DIR2, 0)
-
-        write_reg(CMD_PWM1, speed.val * 10 / 3)
-        write_reg(CMD_PWM2, speed.val * 10 / 3)
-        time.sleep(0.07)
-
-        write_reg(CMD_PWM1, speed.val * 20 / 3)
-        write_reg(CMD_PWM2, speed.val * 20 / 3)
-        time.sleep(0.07)
-
-        write_reg(CMD_PWM1, speed.val * 10)
-        write_reg(CMD_PWM2, speed.val * 10)
+    drive_pressed('backward right', BACKWARD, -1)
 
-    global state_servo_1
-    state_servo_1 = current_angle.val - turning_angle.val
-    state_servo_1 = constrain(state_servo_1, 0, 180)
-    current_angle.val = 180 - state_servo_1
-    if have_smbus:
-        write_servo(CMD_SERVO1, state_servo_1 + fine_servo_1.val)
+def backward_right_released():
+    drive_released(straighten=True)
 
 
-def backward_right_released():
-    print('stop!', flush=True)
-    current_angle.val = 90
-    if have_smbus:
-        write_reg(CMD_PWM1, 0)
-        write_reg(CMD_PWM2, 0)
-        write_servo(CMD_SERVO1, 90 + fine_servo_1.val)
+# called by the watchdog when the main loop stalls.
+# Stop at top priority, even if we think the motors are already stopped:
+def watchdog_stop():
+    global last_replay_dump
+    driving = motion.pwm > 0 or motion.target_pwm > 0
+    motion.stop()
+    write_reg(CMD_PWM1, 0, force=True)
+    write_reg(CMD_PWM2, 0, force=True)
+    # and keep the video of what led up to it, if we were actually moving:
+    now = time.monotonic()
+    if frame_ring is not None and driving and (last_replay_dump is None or now - last_replay_dump >= replay_interval):
+        last_replay_dump = now
+        frame_ring.dump(replay_seconds)
 
 
 def cam_up_pressed():
@@ -622,7 +556,7 @@ def cam_up_pressed():
     vertical.val = state_servo_3
     if have_smbus:
         # write_reg(CMD_SERVO3, num_map(state_servo_3, 0, 180, 500, 2500))
-        write_servo(CMD_SERVO3, state_servo_3 + fine_servo_3.val)
+        servos.move(CMD_SERVO3, state_servo_3)
 
 def cam_up_released():
     pass
@@ -634,7 +568,7 @@ def cam_down_pressed():
     vertical.val = state_servo_3
     if have_smbus:
         # write_reg(CMD_SERVO3, num_map(state_servo_3, 0, 180, 500, 2500))
-        write_servo(CMD_SERVO3, state_servo_3 + fine_servo_3.val)
+        servos.move(CMD_SERVO3, state_servo_3)
 
 def cam_down_released():
     pass
@@ -649,8 +583,8 @@ def cam_home_pressed():
     if have_smbus:
         # write_reg(CMD_SERVO2, num_map(90, 0, 180, 500, 2500))
         # write_reg(CMD_SERVO3, num_map(90, 0, 180, 500, 2500))
-        write_servo(CMD_SERVO2, 90 + fine_servo_2.val)
-        write_servo(CMD_SERVO3, 90 + fine_servo_3.val)
+        servos.move(CMD_SERVO2, 90)
+        servos.move(CMD_SERVO3, 90)
 
 def cam_home_released():
     pass
@@ -663,7 +597,7 @@ def cam_left_pressed():
     horizontal.val = state_servo_2
     if have_smbus:
         # write_reg(CMD_SERVO2, num_map(180 - state_servo_2, 0, 180, 500, 2500))
-        write_servo(CMD_SERVO2, 180 - state_servo_2 - fine_servo_2.val)
+        servos.move(CMD_SERVO2, state_servo_2)
 
 def cam_left_released():
     pass
@@ -676,7 +610,7 @@ def cam_right_pressed():
     horizontal.val = state_servo_2
     if have_smbus:
         # write_reg(CMD_SERVO2, num_map(180 - state_servo_2, 0, 180, 500, 2500))
-        write_servo(CMD_SERVO2, 180 - state_servo_2 - fine_servo_2.val)
+        servos.move(CMD_SERVO2, state_servo_2)
 
 def cam_right_released():
     pass
@@ -687,31 +621,50 @@ def vertical_moved(val):
     # print(state_servo_3)
     if have_smbus:
         # write_reg(CMD_SERVO3, num_map(state_servo_3, 0, 180, 500, 2500))
-        write_servo(CMD_SERVO3, state_servo_3 + fine_servo_3.val)
+        servos.move(CMD_SERVO3, state_servo_3)
 
 def horizontal_moved(val):
     global state_servo_2
     state_servo_2 = int(val)
     if have_smbus:
         # write_reg(CMD_SERVO2, num_map(180 - state_servo_2, 0, 180, 500, 2500))
-        write_servo(CMD_SERVO2, 180 - state_servo_2 - fine_servo_2.val)
+        servos.move(CMD_SERVO2, state_servo_2)
 
 def current_angle_moved(val):
     global state_servo_1
     state_servo_1 = int(val)
     if have_smbus:
-        # write_reg(CMD_SERVO1, num_map(state_servo_1, 0, 180, 500, 2500))
-        write_servo(CMD_SERVO1, state_servo_1 + fine_servo_1.val)
+        motion.drive(steer=state_servo_1)
 
 
 def map_moved(val):
     global state_servo_2
     global state_servo_3
     state_servo_2 = val[0]
-    state_servo_3 = val[1]
+    state_servo_3 = 180 - val[1]  # the top of the map is camera up
+    if have_smbus:
+        servos.move(CMD_SERVO2, state_servo_2)
+        servos.move(CMD_SERVO3, state_servo_3)
+
+
+# the fine tuning sliders set the servo trims, which are saved in servo-calibration.json on exit:
+def fine_servo_1_moved(val):
+    calibration.set_trim(CMD_SERVO1, val)
+    if have_smbus:
+        motion.drive(steer=state_servo_1)
+
+def fine_servo_2_moved(val):
+    calibration.set_trim(CMD_SERVO2, val)
     if have_smbus:
-        write_servo(CMD_SERVO2, 180 - state_servo_2 - fine_servo_2.val)
-        write_servo(CMD_SERVO3, 180 - state_servo_3 - fine_servo_3.val)
+        servos.resend(CMD_SERVO2)
+
+def fine_servo_3_moved(val):
+    calibration.set_trim(CMD_SERVO3, val)
+    if have_smbus:
+        servos.resend(CMD_SERVO3)
+
+def fine_servo_4_moved(val):
+    calibration.set_trim(CMD_SERVO4, val)
 
 
 # def mousebuttondown():
@@ -761,58 +714,40 @@ if __name__ == '__main__':
 
     # initialize the car:
     if have_smbus:
+        # start the bus writer thread:
+        shadow = ShadowRegisters()
+        bus_writer = BusWriter(bus, smbus_address, shadow=shadow)
+        bus_writer.start()
+
+        # start the motor ramp thread:
+        motion = MotionController(bus_writer.write_batch, servo_pulse=steering_pulse, wait_written=bus_writer.wait_written)
+        motion.start()
+
+        # start the camera servo thread, so the camera doesn't slam into position:
+        servos = ServoMotion(write_servo, max_velocity=camera_servo_velocity)
+        servos.start()
+
         # set servo's to initial state:
         # write_reg(CMD_SERVO1, num_map(state_servo_1, 0, 180, 500, 2500))
         # write_reg(CMD_SERVO2, num_map(state_servo_2, 0, 180, 500, 2500))
         # write_reg(CMD_SERVO3, num_map(state_servo_3, 0, 180, 500, 2500))
-        write_servo(CMD_SERVO1, state_servo_1)
-        write_servo(CMD_SERVO2, state_servo_2)
-        write_servo(CMD_SERVO3, state_servo_3)
+        motion.drive(steer=state_servo_1)
+        servos.set_position(CMD_SERVO2, state_servo_2)
+        servos.set_position(CMD_SERVO3, state_servo_3)
 
         # confirm buzzer off:
         # write_reg(CMD_BUZZER, 0)
 
-        # flash LED's and buzz:
-        for _ in range(2):
-            write_reg(CMD_BUZZER, 2000)
-            write_reg(CMD_IO1, 0)
-            write_reg(CMD_IO2, 1)
-            write_reg(CMD_IO3, 1)
-            time.sleep(0.25)
-            write_reg(CMD_BUZZER, 3000)
-            write_reg(CMD_IO1, 1)
-            write_reg(CMD_IO2, 0)
-            write_reg(CMD_IO3, 1)
-            time.sleep(0.25)
-            write_reg(CMD_BUZZER, 4000)
-            write_reg(CMD_IO1, 1)
-            write_reg(CMD_IO2, 1)
-            write_reg(CMD_IO3, 0)
-            time.sleep(0.25)
-            write_reg(CMD_BUZZER, 0)
-            time.sleep(0.2)
-
-        # set LED's:
-        if is_red:
-            write_reg(CMD_IO1, 0)
-            button_red_color = RED
-        else:
-            write_reg(CMD_IO1, 1)
-            button_red_color = GREY2
-
-        if is_green:
-            write_reg(CMD_IO2, 0)
-            button_green_color = GREEN
-        else:
-            write_reg(CMD_IO2, 1)
-            button_green_color = GREY2
-
-        if is_blue:
-            write_reg(CMD_IO3, 0)
-            button_blue_color = BLUE
-        else:
-            write_reg(CMD_IO3, 1)
-            button_blue_color = GREY2
+        # flash LED's and buzz, on the pattern thread, so the GUI comes up straight away.
+        # The LED's are set to match the buttons once it is done:
+        flash_and_buzz = repeat(sequence(
+            step({CMD_BUZZER: 2000, CMD_IO1: 0, CMD_IO2: 1, CMD_IO3: 1}, 0.25),
+            step({CMD_BUZZER: 3000, CMD_IO1: 1, CMD_IO2: 0, CMD_IO3: 1}, 0.25),
+            step({CMD_BUZZER: 4000, CMD_IO1: 1, CMD_IO2: 1, CMD_IO3: 0}, 0.25),
+            step({CMD_BUZZER: 0}, 0.2)), 2)
+        patterns = PatternPlayer(write_reg)
+        patterns.start()
+        patterns.play(flash_and_buzz, then=show_leds)
 
     # insert smart car border:
     # surface = pygame.surface.Surface((324, 244))
@@ -852,19 +787,19 @@ if __name__ == '__main__':
     # servo 1, 2, 3, 4:
     text_surf = font.render('Servo 1', 1, BLACK)
     screen.blit(text_surf, (320 + 60 + 40 + 20 - 320 + cx, 60))
-    fine_servo_1 = Slider("Servo 1", 0, 10, -10, 540 - 320 + cx, 60)
+    fine_servo_1 = Slider("Servo 1", calibration.trim(CMD_SERVO1), 10, -10, 540 - 320 + cx, 60, action=fine_servo_1_moved)
 
     text_surf = font.render('Servo 2', 1, BLACK)
     screen.blit(text_surf, (320 + 60 + 40 + 20 - 320 + cx, 100))
-    fine_servo_2 = Slider("Servo 2", 0, 10, -10, 540 - 320 + cx, 100)
+    fine_servo_2 = Slider("Servo 2", calibration.trim(CMD_SERVO2), 10, -10, 540 - 320 + cx, 100, action=fine_servo_2_moved)
 
     text_surf = font.render('Servo 3', 1, BLACK)
     screen.blit(text_surf, (320 + 60 + 40 + 20 - 320 + cx, 140))
-    fine_servo_3 = Slider("Servo 3", 0, 10, -10, 540 - 320 + cx, 140)
+    fine_servo_3 = Slider("Servo 3", calibration.trim(CMD_SERVO3), 10, -10, 540 - 320 + cx, 140, action=fine_servo_3_moved)
 
     text_surf = font.render('Servo 4', 1, BLACK)
     screen.blit(text_surf, (320 + 60 + 40 + 20 - 320 + cx, 180))
-    fine_servo_4 = Slider("Servo 4", 0, 10, -10, 540 - 320 + cx, 180)
+    fine_servo_4 = Slider("Servo 4", calibration.trim(CMD_SERVO4), 10, -10, 540 - 320 + cx, 180, action=fine_servo_4_moved)
 
     # turning angle:
     text_surf = font.render('Turning angle', 1, BLACK)
@@ -908,6 +843,7 @@ if __name__ == '__main__':
     button_green = Button("Green", (60 + 320 - 320 + cx, 70), green_pressed, green_released, bg=button_green_color, font_name="Segoe Print", font_size=16)
     button_blue = Button("Blue", (60 + 320 - 320 + cx, 110), blue_pressed, blue_released, bg=button_blue_color, font_name="Segoe Print", font_size=16)
     button_buzzer = Button("Buzzer", (60 + 320 - 320 + cx, 150), buzzer_pressed, buzzer_released, bg=GREY2, font_name="Segoe Print", font_size=16)
+    button_snapshot = Button("Snapshot", (60 + 320 - 320 + cx, 250), snapshot_pressed, snapshot_released, bg=GREY2, font_name="Segoe Print", font_size=16)
 
     button_forward = Button('FORWARD', (160, 300 - 240 + cy), forward_pressed, forward_released, bg = GREY2, size=(95, 30))
     button_backward = Button('BACKWARD', (160, 380 - 240 + cy), backward_pressed, backward_released, bg = GREY2, size=(95, 30))
@@ -927,6 +863,7 @@ if __name__ == '__main__':
 
     # define our list of buttons:
     buttons = [button_red, button_green, button_blue, button_buzzer, button_forward, button_backward, button_left, button_right]
+    buttons += [button_snapshot]
     # buttons += [button_cam_up, button_cam_down, button_cam_left, button_cam_right, button_cam_home]
     buttons += [button_forward_left, button_forward_right, button_backward_left, button_backward_right]
 
@@ -938,39 +875,109 @@ if __name__ == '__main__':
     # define our list of active maps:
     active_maps = [camera_map]
 
+    # start the deadman watchdog:
+    # (it also dumps the frame ring, once there is one)
+    frame_ring = None
+    last_replay_dump = None
+    if have_smbus:
+        watchdog = Watchdog(watchdog_stop, watchdog_deadline)
+        watchdog.start()
+
+    # capture camera frames on their own thread, so the main loop never waits on the camera:
+    if have_camera:
+        capture = CaptureThread(cam)
+        capture.start()
+
+        # scale and flip into reused surfaces, set SMART_CAR_DEBUG_FRAMES=1 to count allocations and garbage collections:
+        pipeline = FramePipeline(camera_size, hflip, vflip, debug=bool(os.environ.get('SMART_CAR_DEBUG_FRAMES')), smooth=True)
+
+        # frame timings, logged every 10 seconds, press 'o' to show them over the preview:
+        frame_stats = FrameStats(capture)
+
+        # press 'r' to start and stop recording the camera, to recordings/<date and time>/:
+        recorder = Recorder('recordings', cs, hflip, vflip)
+        capture.on_frame.append(recorder.add_frame)
+
+        # always keep the last replay_seconds of frames, at preview size, in a memory mapped file, dumps go to recordings/:
+        frame_ring = FrameRing(os.path.join(replay_ring_directory, 'smart-car-frame-ring.dat'), camera_size, replay_seconds, hflip=hflip, vflip=vflip,
+                               dump_directory='recordings')
+        capture.on_frame.append(frame_ring.add_frame)
+        frame_ring.dump_on_signal()
+
+        snapshots = Snapshots('snapshots', hflip, vflip)
+    show_overlay = False
+
     # the event loop:
-    camera_counter = 0
+    shown_sequence = 0
+    preview = PreviewScheduler(preview_budget)
     while True:
-        if camera_counter == 0:
-            if have_camera:
-                # start_time = time.time()
-                if cam.query_image():
-                    img = cam.get_image()
-                    img = pygame.transform.scale(img, camera_size)
-                    if hflip or vflip:
-                        img = pygame.transform.flip(img, hflip, vflip)
+        preview.start_loop()
+        if have_smbus:
+            watchdog.heartbeat()
+
+        # show the newest frame, if there is one we haven't shown yet:
+        if have_camera:
+            with capture.lock:
+                if capture.sequence != shown_sequence and preview.due():
+                    shown_sequence = capture.sequence
+                    frame_stats.new_frame(capture.sequence, capture.frame_time)
+                    start_time = time.monotonic()
+                    img = pipeline.process(capture.front)
+                    frame_stats.stage('scale/flip', start_time)
+                    start_time = time.monotonic()
                     screen.blit(img, (2, 2))
-                    pygame.display.flip()
-                # end_time = time.time()
-                # delta_time = end_time - start_time
-                # print(delta_time)
-        camera_counter += 1
-        camera_counter %= camera_frequency
-        print(camera_counter)
+                    frame_stats.stage('blit', start_time)
+                    preview.shown()
+                elif preview.due():
+                    frame_stats.missed()
+            if show_overlay:
+                start_time = time.monotonic()
+                frame_stats.draw(screen, (6, 6))
+                frame_stats.stage('overlay', start_time)
 
         for event in pygame.event.get():
             if event.type == pygame.QUIT:
+                # first the watchdog, the steps below can block, and we don't want a stall (and a dump) now:
+                if have_smbus:
+                    watchdog.close()
                 # stop camera:
                 if have_camera:
+                    recorder.close()
+                    capture.close()
                     cam.stop()
+                    frame_ring.close()
+                    print(capture.report())
+                    print(pipeline.report())
+                    print(preview.report())
+                    if recorder.recorded or recorder.dropped:
+                        print(recorder.report())
+                # save the servo fine tuning:
+                calibration.save()
                 # switch off LED's:
                 if have_smbus:
+                    patterns.close()
                     write_reg(CMD_IO1, 1)
                     write_reg(CMD_IO2, 1)
                     write_reg(CMD_IO3, 1)
+                    # make sure everything queued actually reaches the car:
+                    servos.close()
+                    motion.close()
+                    bus_writer.stop()
+                    print(watchdog.report())
+                    print(bus_writer.report())
+                    print(shadow.report())
                 # quit pygame:
                 pygame.quit()
                 sys.exit()
+            elif event.type == pygame.KEYDOWN:
+                if event.key == pygame.K_p and bus_profiler is not None:
+                    bus_profiler.dump()
+                elif event.key == pygame.K_o and have_camera:
+                    show_overlay = not show_overlay
+                elif event.key == pygame.K_r and have_camera:
+                    recorder.toggle()
+                elif event.key == pygame.K_d and have_camera:
+                    frame_ring.dump(replay_seconds)
             elif event.type == pygame.MOUSEBUTTONDOWN:
                 # mousebuttondown()
                 pos = pygame.mouse.get_pos()
@@ -1019,4 +1026,6 @@ if __name__ == '__main__':
             amap.draw()
 
         pygame.display.flip()
-        pygame.time.wait(40)
+        if have_camera:
+            frame_stats.displayed()
+        pygame.time.wait(preview.end_loop())
@@ -0,0 +1,230 @@
+#######################################################################
+# motor control for the smart car
+#
+# the old *_pressed callbacks soft-started the motors with time.sleep(0.07) between steps,
+# which froze the GUI for about 140ms on every press.
+# Now the ramp runs on its own thread at a fixed control rate,
+# and a new press or a release takes over straight away, even half way through a ramp.
+#
+# drive(direction, speed, steer) is the one way in, for the motors and the steering servo.
+# It remembers what the car already has, and only writes the registers that change,
+# as one batch, eg, a speed change is just PWM1 and PWM2, a turn is just SERVO1.
+# A change of direction first stops the motors, and only once the stop has actually gone out on the bus
+# does the motion thread write DIR and ramp back up, so the car never flips direction at speed,
+# and a quick release and press the other way can't have its stop merged away by the bus writer.
+#
+# Author: Garry Morrison
+# email: garry.morrison _at_ gmail.com
+# Date: 18/10/2026
+# Update: 18/10/2026
+# Copyright: GPLv3
+#
+# Usage:
+#   motion = MotionController(bus_writer.write_batch, servo_pulse=lambda angle: calibration.pulse(CMD_SERVO1, angle),
+#                             wait_written=bus_writer.wait_written)
+#   motion.start()
+#   motion.drive(FORWARD, 500)
+#   motion.drive(steer=120)
+#   motion.stop()
+#   motion.close()
+#
+#######################################################################
+
+import threading
+import time
+from car_bus import CMD_SERVO1, CMD_PWM1, CMD_PWM2, CMD_DIR1, CMD_DIR2
+from servo import ServoCalibration
+
+
+FORWARD = 1
+BACKWARD = 0
+
+
+# ramp profiles, map the fraction of the ramp time gone (0 to 1) to the fraction of the target speed:
+def linear(x):
+    return x
+
+
+def s_curve(x):
+    return x * x * (3 - 2 * x)
+
+
+# precompute a ramp as one speed fraction per control tick.
+# profile is either one of the functions above, or already a table (eg, [1/3, 1/3, 1/3, 1/3, 2/3, 2/3, 2/3, 1])
+def make_ramp_table(profile, ramp_time, rate):
+    if not callable(profile):
+        return list(profile)
+    steps = max(1, round(ramp_time * rate))
+    return [profile((k + 1) / steps) for k in range(steps)]
+
+
+class MotionController():
+    def __init__(self, write_batch, rate=50, ramp_time=0.14, profile=s_curve, servo_pulse=None, wait_written=None):
+        self.write_batch = write_batch
+        # wait_written(cmd, ticket, timeout), to know when a queued write has reached the car.
+        # Without it, write_batch() is taken to have written them by the time it returns:
+        self.wait_written = wait_written
+        self.stop_timeout = 1  # give up waiting for the stop after this many seconds, and flip anyway
+        if servo_pulse is None:
+            # the saved steering servo calibration, pass in your own if you have a ServoCalibration already:
+            calibration = ServoCalibration()
+            servo_pulse = lambda angle: calibration.pulse(CMD_SERVO1, angle)
+        self.servo_pulse = servo_pulse  # steering angle -> servo pulse width
+        self.rate = rate
+        self.period = 1 / rate
+        self.ramp_table = make_ramp_table(profile, ramp_time, rate)
+
+        self.registers = {}  # what we last wrote to DIR1, DIR2, PWM1, PWM2, SERVO1
+        self.tickets = {}  # cmd -> the bus writer's ticket for that last write
+        self.direction = None  # current direction, None if we don't know
+        self.pwm = 0  # current speed
+        self.target_pwm = 0  # where the current ramp is heading
+        self.ramp = None  # (start pwm, target pwm, start time), while a ramp is running
+        self.reversing = False  # True from a change of direction, till the motion thread has written DIR
+
+        self.running = False
+        self.cond = threading.Condition()
+        self.thread = None
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name='motion', daemon=True)
+        self.thread.start()
+
+    def close(self):
+        with self.cond:
+            self.running = False
+            self.cond.notify_all()
+        if self.thread is not None:
+            self.thread.join(1)
+            self.thread = None
+
+    def set_profile(self, profile, ramp_time=0.14):
+        with self.cond:
+            self.ramp_table = make_ramp_table(profile, ramp_time, self.rate)
+
+    # write only the registers that differ from what the car already has, as one batch:
+    def apply(self, target):
+        changed = [cmd for cmd in (CMD_DIR1, CMD_DIR2, CMD_PWM1, CMD_PWM2, CMD_SERVO1) if cmd in target and self.registers.get(cmd) != target[cmd]]
+
+        # if we are slowing down, send PWM before DIR, so we never flip direction at speed:
+        if CMD_PWM1 in target and target[CMD_PWM1] < self.registers.get(CMD_PWM1, 0):
+            changed.sort(key=lambda cmd: cmd not in (CMD_PWM1, CMD_PWM2))
+
+        writes = [(cmd, target[cmd]) for cmd in changed]
+        for cmd, value in writes:
+            self.registers[cmd] = value
+        if writes:
+            tickets = self.write_batch(writes)
+            if tickets:
+                for (cmd, _), ticket in zip(writes, tickets):
+                    self.tickets[cmd] = ticket
+
+    def set_pwm(self, pwm, target=None):
+        self.pwm = int(pwm)
+        if target is None:
+            target = {}
+        target[CMD_PWM1] = self.pwm
+        target[CMD_PWM2] = self.pwm
+        self.apply(target)
+
+    # set any of direction, speed and steering angle, None means leave it as is.
+    # (the steering trim is already in servo_pulse(), from the servo calibration)
+    # A new speed ramps from where we are now, a speed of 0 stops straight away.
+    def drive(self, direction=None, speed=None, steer=None):
+        with self.cond:
+            target = {}
+            if steer is not None:
+                target[CMD_SERVO1] = self.servo_pulse(steer)
+
+            if direction is not None and direction != self.direction:
+                if speed is None:
+                    speed = self.target_pwm
+                # never flip direction with the motors running. Stop now,
+                # and the motion thread writes DIR, and ramps up from 0, once the stop has reached the car:
+                self.ramp = None
+                self.set_pwm(0, target)
+                self.direction = direction
+                self.target_pwm = int(speed)
+                self.reversing = True
+                self.cond.notify()
+            elif self.reversing and speed is not None:
+                # still waiting on the stop, the motion thread ramps to this speed instead:
+                self.target_pwm = int(speed)
+                self.apply(target)
+            elif speed is None:
+                # just steering, leave the motors (and any ramp) alone:
+                self.apply(target)
+            elif speed == 0:
+                self.ramp = None
+                self.target_pwm = 0
+                self.set_pwm(0, target)
+            else:
+                self.target_pwm = int(speed)
+                self.ramp = (self.pwm, self.target_pwm, time.monotonic())
+                self.tick(self.ramp[2], target)  # first step right now, the rest from the thread
+                self.cond.notify()
+
+    # stop now, no ramp:
+    def stop(self):
+        self.drive(speed=0)
+
+    def tick(self, now, target=None):
+        start_pwm, target_pwm, start_time = self.ramp
+        k = round((now - start_time) * self.rate)
+        if k >= len(self.ramp_table) - 1:
+            self.set_pwm(target_pwm, target)
+            self.ramp = None
+        else:
+            self.set_pwm(start_pwm + (target_pwm - start_pwm) * self.ramp_table[k], target)
+
+    # wait, without the lock, till the last PWM writes (the stop) have gone out on the bus:
+    def wait_stopped(self, tickets):
+        if self.wait_written is None:
+            return
+        for cmd, ticket in tickets.items():
+            if ticket is not None and not self.wait_written(cmd, ticket, self.stop_timeout):
+                print('motion: stop not written after %ss, changing direction anyway' % self.stop_timeout)
+
+    # the motors are stopped, so now change direction, and start the ramp, in one batch:
+    def finish_reversing(self):
+        self.reversing = False
+        target = {CMD_DIR1: self.direction, CMD_DIR2: self.direction}
+        if self.target_pwm > 0:
+            self.ramp = (0, self.target_pwm, time.monotonic())
+            self.tick(self.ramp[2], target)
+        else:
+            self.apply(target)
+
+    def run(self):
+        while True:
+            with self.cond:
+                self.cond.wait_for(lambda: self.ramp is not None or self.reversing or not self.running)
+                if not self.running:
+                    return
+                if self.reversing:
+                    tickets = {cmd: self.tickets.get(cmd) for cmd in (CMD_PWM1, CMD_PWM2)}
+                else:
+                    self.run_ramp()
+                    continue
+            self.wait_stopped(tickets)
+            with self.cond:
+                # (drive() may have changed the direction or speed again meanwhile, we go with the newest)
+                if self.reversing and self.running:
+                    self.finish_reversing()
+
+    # (call with self.cond held)
+    def run_ramp(self):
+        # step through the ramp at our fixed rate.
+        # drive() and stop() can replace or cancel it while we wait:
+        ramp = None
+        while self.ramp is not None and self.running:
+            if self.ramp is not ramp:
+                ramp = self.ramp
+                next_time = ramp[2] + self.period
+            delay = next_time - time.monotonic()
+            if delay > 0:
+                self.cond.wait(delay)
+                continue
+            self.tick(next_time)
+            next_time += self.period
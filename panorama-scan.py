@@ -36,6 +36,11 @@ import sys
 # import cv2
 import os
 import pygame
+from car_bus import ShadowRegisters, ProfiledBus, CMD_SERVO2
+from servo import ServoMotion, ServoCalibration
+from image_tools import SettleDetector, FrameAccumulator, simm_average
+from leds import PatternPlayer, tone
+from camera import camera_flip, FramePipeline, open_camera
 
 
 # beep to indicated start and end of panorama-scan:
@@ -43,7 +48,7 @@ beep = True
 
 
 # try to set up smbus:
-# (this will only work on the raspberry pi)
+# (this will only work on the raspberry pi, unless SMART_CAR_FAKE_SMBUS=1 is set to use the simulated car)
 try:
     import smbus
     smbus_address = 0x18  # default address
@@ -51,8 +56,19 @@ try:
     bus.open(1)
     have_smbus = True
 except ImportError:
-    print('failed to import smbus')
-    sys.exit(-1)
+    if not os.environ.get('SMART_CAR_FAKE_SMBUS'):
+        print('failed to import smbus')
+        sys.exit(-1)
+    print('failed to import smbus, using simulated smbus')
+    import fake_smbus as smbus
+    smbus_address = 0x18  # default address
+    bus = smbus.SMBus(1)
+    have_smbus = True
+
+# optionally profile the bus (kill -USR1 to see the report, it also prints on exit):
+if os.environ.get('SMART_CAR_PROFILE_BUS'):
+    bus = ProfiledBus(bus)
+    bus.dump_on_signal()
 
 
 # start up pygame:
@@ -69,29 +85,39 @@ camera_size = (1024, 768)
 hflip = True
 vflip = True
 
-# try to set up the camera using pygame:
-try:
-    import pygame.camera
-    pygame.camera.init()
-    camera_list = pygame.camera.list_cameras()
-    if not camera_list:
-        print('failed to find a camera')
-        sys.exit(-1)
-    else:
-        cam = pygame.camera.Camera(camera_list[0], camera_size)
-        cam.start()
-        cs = cam.get_size()
-        print('camera size: %s' % str(cs))
-except ImportError:
+# try to set up the camera:
+# (SMART_CAR_CAMERA picks the backend, see camera.py)
+cam = open_camera(camera_size)
+if cam is None:
     print('failed to find a camera')
     sys.exit(-1)
+cam.start()
+cs = cam.get_size()
+print('camera size: %s' % str(cs))
+# let the camera do the flipping if it can:
+hflip, vflip = camera_flip(cam, hflip, vflip)
+
+# does any flipping the camera couldn't, into a reused surface:
+pipeline = FramePipeline(cs, hflip, vflip)
 
 # number of images to average over:
 # count = 20
 count = 1
 
-# sleep time, in seconds, between changing angle and taking a photo:
-SLEEP_TIME = 1
+# rather than sleeping a fixed time between changing angle and taking a photo,
+# we wait till SETTLE_FRAMES consecutive (downsampled) frames are at least SETTLE_SIMILARITY similar,
+# or SETTLE_TIMEOUT seconds, whichever comes first:
+SETTLE_SIMILARITY = 0.97
+SETTLE_FRAMES = 3
+SETTLE_TIMEOUT = 2
+
+# number of frames get_single_image() throws away first.
+# The settle detection has already flushed any stale frames, so we don't need 10 any more:
+DISCARD_FRAMES = 2
+
+# max camera servo speed in degrees per second, and acceleration in degrees per second per second:
+SERVO_VELOCITY = 60
+SERVO_ACCELERATION = 300
 
 # min similarity for image to be considered valid during image similarity averaging:
 IMAGE_SIMILARITY = 0.75
@@ -101,21 +127,6 @@ min_angle = 0
 max_angle = 180
 step_angle = 5
 
-# image capture function:
-get_image = get_single_image
-# get_image = create_average_camera_image
-# get_image = create_simm_average_camera_image
-
-
-# define IO constants:
-CMD_SERVO1 = 0
-CMD_SERVO2 = 1
-CMD_SERVO3 = 2
-CMD_SERVO4 = 3
-CMD_BUZZER = 8
-SERVO_MAX_PULSE_WIDTH = 2500
-SERVO_MIN_PULSE_WIDTH = 500
-
 
 def constrain(val, min_val, max_val):
     val = max(val, min_val)
@@ -127,20 +138,32 @@ def num_map(value, fromLow, fromHigh, toLow, toHigh):
     return (toHigh-toLow)*(value-fromLow) / (fromHigh-fromLow) + toLow
 
 
-def write_reg(cmd, value):
+# skip writes that wouldn't change a register, unless force is set:
+shadow = ShadowRegisters()
+
+
+def write_reg(cmd, value, force=False):
     try:
         value = int(value)
+        if force:
+            shadow.invalidate(cmd)
+        if not shadow.needs_write(cmd, value):
+            return
         bus.write_i2c_block_data(smbus_address, cmd, [value >> 8, value & 0xff])
+        shadow.update(cmd, value)
         time.sleep(0.001)
     except Exception as e:
+        shadow.invalidate(cmd)
         print('write_reg exception: %s' % e)
 
 
+# use the same servo calibration (pulse widths, trim, inverted or not) as the GUI:
+calibration = ServoCalibration()
+
+
 def write_servo(cmd, value):
     try:
-        value = constrain(value, 0, 180)
-        value = int(num_map(value, 0, 180, SERVO_MIN_PULSE_WIDTH, SERVO_MAX_PULSE_WIDTH))
-        write_reg(cmd, value)
+        write_reg(cmd, calibration.pulse(cmd, value))
     except Exception as e:
         print('write_servo exception: %s' % e)
 
@@ -148,102 +171,46 @@ def write_servo(cmd, value):
 # assumes, for now, there is no movement at all while trying to take the average:
 # hrmmm.. still has ghost effect. Need to filter using image-simm()
 # NB: opencv version.
+# needs the opencv camera backend, SMART_CAR_CAMERA=opencv:
 def opencv_create_average_camera_image(count):
-    # create a list of first count frames:
-    img = [cap.read()[1] for i in range(count)]
-
-    # rotate images:
-    rot_img = [cv2.flip(i, -1) for i in img]
-
-    # convert all to float64:
-    float_img = [np.float64(i) for i in rot_img]
-
-    # find the average:
-    mean_img = float_img[0]
-    for k in range(1, count):
-        mean_img += float_img[k]
-    mean_img /= count
-
-    # Convert back to uint8:
-    int_mean_img = np.uint8(np.clip(mean_img, 0, 255))
+    # add up count frames, rotated by us if the camera didn't do it (opencv frames are indexed [y, x]):
+    acc = FrameAccumulator()
+    for _ in range(count):
+        acc.add(cam.read()[::-1 if vflip else 1, ::-1 if hflip else 1])
 
-    return int_mean_img
+    # find the average, as uint8:
+    return acc.image()
 
 
 # pygame version: code untested!
 def create_average_camera_image(count):
-    rot_img = []
+    # add up count frames, straight from the camera's surfaces:
+    acc = FrameAccumulator()
     for _ in range(count):
-        img = cam.get_image()
-        img = pygame.surfarray.array3d(img)
-        rot_img.append(img)
-
-    # convert all to float64:
-    float_img = [np.float64(i) for i in rot_img]
-
-    # find average of similar images:
-    mean_img = float_img[0]
-    for k in range(1, count):
-        mean_img += float_img[k]
-    mean_img /= count
+        acc.add(pygame.surfarray.pixels3d(cam.get_image()))
     print('we averaged %s images' % count)
 
-    # Convert back to uint8:
-    int_mean_img = np.uint8(np.clip(mean_img, 0, 255))
-
-    # convert back to pygame surface:
-    frame = pygame.surfarray.make_surface(int_mean_img)
+    # find the average, and convert back to pygame surface:
+    frame = pygame.surfarray.make_surface(acc.image())
 
     return frame
 
 
-# returns the image similarity of two images:
-# 1 for exact match,
-# 0 for completely distinct
-# values in between otherwise
-def image_simm(im1, im2):
-    # convert all to float64:
-    fim1 = np.float64(im1)
-    fim2 = np.float64(im2)
-
-    s1 = np.sum(fim1)
-    s2 = np.sum(fim2)
-
-    if s1 == 0 or s2 == 0:
-        return 0
-
-    # wfg = sum(abs(f[k]/s1 - g[k]/s2) for k in range(the_len))
-    wfg = np.sum(np.absolute(fim1 / s1 - fim2 / s2))
-
-    return (2 - wfg) / 2
-
-
 # this still has some minor ghosting!
 def create_simm_average_camera_image(count):
-    rot_img = []
-    for _ in range(count):
-        img = cam.get_image()
-        img = pygame.surfarray.array3d(img)
-        rot_img.append(img)
-
-    # convert all to float64:
-    float_img = [np.float64(i) for i in rot_img]
-
-    # find average of similar images:
-    mean_img = float_img[-1]
-    i = 1
-    for k in range(1, count):
-        tmp_img = float_img[k]
-        # r = image_simm(float_img[0], tmp_img)
-        r = image_simm(mean_img, tmp_img)
-        if r > IMAGE_SIMILARITY:                  # currently 80% similarity. Maybe another value would work better?
-            mean_img += tmp_img
-            i += 1
-    mean_img /= i
-    print('we averaged %s images' % i)
-
-    # Convert back to uint8:
-    int_mean_img = np.uint8(np.clip(mean_img, 0, 255))
+    # grab the whole burst into one uint8 array:
+    frames = None
+    for k in range(count):
+        img = pygame.surfarray.pixels3d(cam.get_image())
+        if frames is None:
+            frames = np.empty((count,) + img.shape, np.uint8)
+        np.copyto(frames[k], img)
+        del img
+
+    # find average of images similar to the median one:
+    # (currently 75% similarity. Maybe another value would work better?)
+    int_mean_img, simm, accepted = simm_average(frames, IMAGE_SIMILARITY)
+    print('we averaged %s of %s images, similarity %.3f to %.3f' % (np.count_nonzero(accepted), count, simm.min(), simm.max()))
 
     # convert back to pygame surface:
     frame = pygame.surfarray.make_surface(int_mean_img)
@@ -256,10 +223,21 @@ def create_simm_average_camera_image(count):
 # BTW, with outside images, seems we don't need to simm-average them.
 # Only inside images, where there are lower light levels, have the extra noise that require image averaging.
 def get_single_image(count):
-    img = [cam.get_image() for _ in range(10)]
+    img = [cam.get_image() for _ in range(DISCARD_FRAMES + 1)]
     return img[-1]
 
 
+# image capture function:
+get_image = get_single_image
+# get_image = create_average_camera_image
+# get_image = create_simm_average_camera_image
+
+
+# the settle detector only needs a view of the pixels, it downsamples them itself:
+def get_settle_frame():
+    return pygame.surfarray.pixels3d(cam.get_image())
+
+
 if __name__ == '__main__':
     if len(sys.argv) < 2:
         print('please provide a destination directory for the images')
@@ -299,20 +277,20 @@ if __name__ == '__main__':
     # test our directory selection code works, then exit:
     # sys.exit(0)
 
+    # the beeps play on their own thread, so they don't hold anything up:
+    patterns = PatternPlayer(write_reg)
+    patterns.start()
+
     # beep on startup:
     if beep:
-        write_reg(CMD_BUZZER, 1000)
-        time.sleep(0.2)
-        write_reg(CMD_BUZZER, 0)
+        patterns.play(tone(1000, 0.2))
 
     # sleep 30s
     time.sleep(30)
 
     # warn about to start scan:
     if beep:
-        write_reg(CMD_BUZZER, 2000)
-        time.sleep(0.2)
-        write_reg(CMD_BUZZER, 0)
+        patterns.play(tone(2000, 0.2))
 
     # sleep 5s
     time.sleep(5)
@@ -321,29 +299,52 @@ if __name__ == '__main__':
     # min_angle = 0
     # max_angle = 180
     # step_angle = 5
+    settle = SettleDetector(SETTLE_SIMILARITY, SETTLE_FRAMES, SETTLE_TIMEOUT)
+    total_settle_time = 0
+
+    # move the camera servo smoothly, rather than slamming it into position:
+    servos = ServoMotion(write_servo, max_velocity=SERVO_VELOCITY, max_acceleration=SERVO_ACCELERATION)
+    servos.start()
+
+    # we don't know where the servo is, so jump to the start angle, and give it a full second:
+    # (servo_2 is inverted in the calibration, so no need for 180 - angle any more)
+    servos.set_position(CMD_SERVO2, int(constrain(min_angle, 0, 180)))
+    time.sleep(1)
+
     for angle in range(min_angle, max_angle + step_angle, step_angle):
         angle = int(constrain(angle, 0, 180))
-        print('angle: %s' % angle)
-        write_servo(CMD_SERVO2, 180 - angle)
-
-        # let the camera warm up to current angle:
-        time.sleep(SLEEP_TIME)
+        eta = servos.move(CMD_SERVO2, angle)
+        print('angle: %s, eta: %.2fs' % (angle, eta))
+
+        # wait till the servo gets there, then let the camera warm up to current angle:
+        servos.wait(CMD_SERVO2, eta + 1)
+        settled, settle_time, settle_frames = settle.wait(get_settle_frame)
+        if settled:
+            print('settled in %.2fs, %s frames' % (settle_time, settle_frames))
+        else:
+            print('failed to settle in %.2fs (similarity %.3f), taking the photo anyway' % (settle_time, settle.similarity))
+        total_settle_time += settle_time
 
         # get the image:
         img = get_image(count)
-        img = pygame.transform.flip(img, hflip, vflip)
+        img = pipeline.process(img)
         # img = pygame.transform.scale(img, camera_size)
         pygame.image.save(img, dest_dir + '/' + str(angle) + '.png')
 
     # return camera to 90 degree position:
-    write_servo(CMD_SERVO2, 90)
+    servos.move(CMD_SERVO2, 90)
+    servos.wait(CMD_SERVO2, 5)
+    servos.close()
+    print('total settle time: %.1fs' % total_settle_time)
 
     # tidy up:
     cam.stop()
     pygame.quit()
 
-    # beep on finish:
+    # beep on finish, and let it finish before we exit:
     if beep:
-        write_reg(CMD_BUZZER, 1000)
-        time.sleep(0.2)
-        write_reg(CMD_BUZZER, 0)
+        patterns.play(tone(1000, 0.2))
+        patterns.wait(1)
+    patterns.close()
+
+    print(shadow.report())
@@ -0,0 +1,387 @@
+#######################################################################
+# record camera frames to disk, without ever holding up the capture thread or the GUI
+#
+# add_frame() is called from the capture thread. It copies the frame (flipped, if need be)
+# into one of a fixed number of buffers, made when recording starts, and queues it.
+# If every buffer is still waiting to be written, because the encoder or the disk has fallen behind,
+# the frame is dropped and counted, rather than waiting.
+# The encoder thread writes the frames out, as MJPEG (just the JPEG's one after another,
+# which ffmpeg and vlc can play) or as raw rgb24, in segments of segment_time seconds.
+# Next to each segment is an index file with one "sequence frame_time offset length" line per frame.
+#
+# FrameRing keeps the last few seconds of frames, always, in a numpy memmap,
+# so after a near miss we can still see what happened. Frames are scaled down (eg, to the preview size),
+# and at most fps a second are kept, each copied straight into its slot as 32 bit pixels,
+# nothing is allocated per frame. dump() streams the frames out to a .npz file on its own thread,
+# a few at a time, and the ring stands still till it is done.
+#
+# Snapshots saves a copy of a single frame, as a PNG, on its own thread, so the GUI doesn't freeze.
+#
+# Author: Garry Morrison
+# email: garry.morrison _at_ gmail.com
+# Date: 18/10/2026
+# Update: 18/10/2026
+# Copyright: GPLv3
+#
+# Usage:
+#   recorder = Recorder('recordings', size=camera_size, hflip=hflip, vflip=vflip)
+#   capture.on_frame.append(recorder.add_frame)
+#   recorder.start()
+#   recorder.stop()
+#   recorder.close()
+#   print(recorder.report())
+#
+#   to play an MJPEG recording:
+#   ffplay -f mjpeg recordings/<date>/000.mjpeg
+#
+#   or a raw one:
+#   ffplay -f rawvideo -pixel_format rgb24 -video_size 640x480 recordings/<date>/000.raw
+#
+#   frame_ring = FrameRing('/dev/shm/frame-ring.dat', size=camera_size, seconds=10, dump_directory='recordings')
+#   capture.on_frame.append(frame_ring.add_frame)
+#   frame_ring.dump(5)
+#   frame_ring.close()
+#
+#   and to look at a dump:
+#   replay = np.load('recordings/replay-<date>.npz')
+#   replay['frames'], replay['times']
+#
+#   snapshots = Snapshots('snapshots', hflip, vflip)
+#   snapshots.take(img)
+#
+#######################################################################
+
+import collections
+import io
+import os
+import signal
+import threading
+import zipfile
+import time
+import numpy as np
+import pygame
+from histogram import Histogram
+
+try:
+    import cv2
+    have_opencv = True
+except ImportError:
+    have_opencv = False
+
+
+class Recorder():
+    def __init__(self, directory, size, hflip=False, vflip=False, fmt='mjpeg', buffers=30, segment_time=60, quality=85):
+        self.directory = directory
+        self.size = size
+        self.hflip = hflip
+        self.vflip = vflip
+        self.fmt = fmt  # 'mjpeg' or 'raw'
+        self.segment_time = segment_time  # seconds per file
+        self.quality = quality  # JPEG quality
+
+        # the frames are indexed [x, y] like pygame.surfarray, buffers * width * height * 3 bytes in all,
+        # so they are only made while recording:
+        self.buffers = buffers
+        self.free = []
+        self.queue = collections.deque()  # (buffer, sequence, frame_time, session)
+        self.filling = 0  # buffers taken by add_frame(), not queued yet
+
+        self.recording = False
+        self.cond = threading.Condition()
+        self.thread = None
+        self.session = None  # directory for this recording
+        self.file_session = None  # directory the open segment is in, the writer can still be on the last recording
+        self.file = None
+        self.index = None
+        self.segment = 0
+        self.segment_start = None
+
+        self.sequence = 0
+        self.recorded = 0
+        self.dropped = 0
+        self.bytes = 0
+        self.record_time = 0  # seconds spent recording, for the throughput
+        self.start_time = None
+        self.encode_time = Histogram()
+        self.write_time = Histogram()
+
+    def start(self):
+        with self.cond:
+            if self.recording:
+                return
+            self.session = self.new_session()
+            self.start_time = time.monotonic()
+            self.recording = True
+            # the writer may still be finishing off the last recording, if so, it carries on with this one,
+            # and with its buffers:
+            if self.thread is None:
+                self.free = [np.empty((self.size[0], self.size[1], 3), np.uint8) for _ in range(self.buffers)]
+                self.thread = threading.Thread(target=self.run, name='recorder', daemon=True)
+                self.thread.start()
+        print('recording to %s' % self.session, flush=True)
+
+    # a new directory for each recording, even two in the same second:
+    def new_session(self):
+        name = os.path.join(self.directory, time.strftime('%Y-%m-%d_%H-%M-%S'))
+        session = name
+        k = 1
+        while True:
+            try:
+                os.makedirs(session)
+                return session
+            except FileExistsError:
+                k += 1
+                session = '%s-%s' % (name, k)
+
+    # stop taking frames, never waits, the ones already queued are written in the background:
+    def stop(self):
+        with self.cond:
+            if not self.recording:
+                return
+            self.recording = False
+            self.record_time += time.monotonic() - self.start_time
+            self.cond.notify_all()
+        print('recording stopped', flush=True)
+
+    # stop, and wait for the queued frames to be written, for when we exit:
+    def close(self, timeout=5):
+        self.stop()
+        thread = self.thread
+        if thread is not None:
+            thread.join(timeout)
+
+    def toggle(self):
+        if self.recording:
+            self.stop()
+        else:
+            self.start()
+
+    # called from the capture thread, with each new frame, never waits:
+    def add_frame(self, img, frame_time):
+        with self.cond:
+            if not self.recording:
+                return
+            self.sequence += 1
+            if not self.free or img.get_size() != self.size:
+                self.dropped += 1
+                return
+            buffer = self.free.pop()
+            # which recording it belongs to is decided now, a stop() while we copy doesn't change it:
+            entry = (buffer, self.sequence, frame_time, self.session)
+            self.filling += 1
+        src = pygame.surfarray.pixels3d(img)
+        np.copyto(buffer, src[::-1 if self.hflip else 1, ::-1 if self.vflip else 1])
+        del src
+        with self.cond:
+            self.filling -= 1
+            self.queue.append(entry)
+            self.cond.notify()
+
+    def encode(self, buffer):
+        if self.fmt == 'raw':
+            # rgb24, a row at a time:
+            return buffer.transpose(1, 0, 2).tobytes()
+        if have_opencv:
+            ok, data = cv2.imencode('.jpg', buffer.transpose(1, 0, 2)[:, :, ::-1], [cv2.IMWRITE_JPEG_QUALITY, self.quality])
+            return data.tobytes()
+        data = io.BytesIO()
+        pygame.image.save(pygame.surfarray.make_surface(buffer), data, 'frame.jpg')
+        return data.getvalue()
+
+    def open_segment(self, frame_time):
+        self.close_segment()
+        name = os.path.join(self.file_session, '%03d' % self.segment)
+        self.file = open(name + '.' + self.fmt, 'wb')
+        self.index = open(name + '.txt', 'w')
+        self.segment += 1
+        self.segment_start = frame_time
+
+    def close_segment(self):
+        if self.file is not None:
+            self.file.close()
+            self.index.close()
+            self.file = None
+            self.index = None
+
+    def write(self, buffer, sequence, frame_time, session):
+        start_time = time.monotonic()
+        data = self.encode(buffer)
+        self.encode_time.add(time.monotonic() - start_time)
+
+        start_time = time.monotonic()
+        if session != self.file_session:
+            # the first frame of a new recording:
+            self.close_segment()
+            self.file_session = session
+            self.segment = 0
+        if self.file is None or frame_time - self.segment_start >= self.segment_time:
+            self.open_segment(frame_time)
+        offset = self.file.tell()
+        self.file.write(data)
+        self.index.write('%s %.6f %s %s\n' % (sequence, frame_time, offset, len(data)))
+        self.write_time.add(time.monotonic() - start_time)
+        self.bytes += len(data)
+        self.recorded += 1
+
+    def run(self):
+        while True:
+            with self.cond:
+                # the writer only finishes once nothing is queued, and no buffer is still being filled:
+                self.cond.wait_for(lambda: self.queue or (not self.recording and not self.filling))
+                if not self.queue:
+                    # stopped, and everything written, so let the buffers go:
+                    self.free = []
+                    self.close_segment()
+                    self.file_session = None
+                    self.thread = None
+                    return
+                buffer, sequence, frame_time, session = self.queue.popleft()
+            try:
+                self.write(buffer, sequence, frame_time, session)
+            except OSError as e:
+                print('recorder exception: %s' % e)
+            with self.cond:
+                self.free.append(buffer)
+
+    def report(self):
+        with self.cond:
+            record_time = self.record_time
+            if self.recording:
+                record_time += time.monotonic() - self.start_time
+            record_time = max(record_time, 1e-9)
+            return 'recorder: %s frames written, %s dropped, %.1fMB, %.2fMB/s, %.1f frames/s\n  encode: %s\n  write:  %s' % (
+                self.recorded, self.dropped, self.bytes / 1e6, self.bytes / 1e6 / record_time, self.recorded / record_time,
+                self.encode_time.summary(), self.write_time.summary())
+
+
+class FrameRing():
+    def __init__(self, filename, size, seconds=10, fps=15, hflip=False, vflip=False, max_bytes=200 * 2 ** 20, dump_directory=None):
+        self.filename = filename
+        # where dump() saves to, by default next to the ring file:
+        self.dump_directory = dump_directory or os.path.dirname(os.path.abspath(filename))
+        self.size = size  # frames are scaled to this, eg, the preview size, not the full capture size
+        self.hflip = hflip
+        self.vflip = vflip
+        self.fps = fps  # at most this many frames a second go in the ring
+        # never more than max_bytes, which at a bigger size means fewer seconds:
+        self.length = min(int(seconds * fps), max_bytes // (size[0] * size[1] * 4))
+        if self.length < seconds * fps:
+            print('frame ring: only room for %.1fs at %sx%s' % (self.length / fps, size[0], size[1]))
+        os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+        # the frames live in a file, so the page cache holds them rather than our heap.
+        # They are kept as 32 bit pixels, indexed [x, y] like pygame.surfarray.pixels2d(),
+        # so a frame goes in as one straight copy, and only a dump pays for converting to rgb:
+        self.frames = np.memmap(filename, np.uint32, 'w+', shape=(self.length, size[0], size[1]))
+        self.scaled = pygame.Surface(size, 0, 32)  # what each frame is scaled into, before the copy
+        self.same_depth = None  # for 8, 16 or 24 bit frames, scaled here then blitted into self.scaled
+        self.shifts = self.scaled.get_shifts()[:3]  # where r, g and b are in each pixel
+
+        self.sequences = np.full(self.length, -1, np.int64)  # -1 for an empty slot
+        self.times = np.zeros(self.length, np.float64)
+        self.count = 0
+        self.last_time = None
+        self.lock = threading.Lock()
+        self.dumping = False
+
+    # called from the capture thread, with each new frame, after the GUI has it.
+    # While a dump is running, the ring is frozen, so nothing it is saving can be overwritten:
+    def add_frame(self, img, frame_time):
+        if self.dumping or (self.last_time is not None and frame_time - self.last_time < 0.9 / self.fps):
+            return
+        self.last_time = frame_time
+        if img.get_bitsize() == 32:
+            src = img if img.get_size() == self.size else pygame.transform.scale(img, self.size, self.scaled)
+        else:
+            if self.same_depth is None or self.same_depth.get_bitsize() != img.get_bitsize():
+                self.same_depth = pygame.Surface(self.size, 0, img)
+            self.scaled.blit(pygame.transform.scale(img, self.size, self.same_depth), (0, 0))
+            src = self.scaled
+        slot = self.count % self.length
+        pixels = pygame.surfarray.pixels2d(src)
+        np.copyto(self.frames[slot], pixels[::-1 if self.hflip else 1, ::-1 if self.vflip else 1])
+        del pixels
+        with self.lock:
+            self.sequences[slot] = self.count
+            self.times[slot] = frame_time
+            self.count += 1
+
+    # the slots of the frames from the last `seconds`, oldest first:
+    def slots(self, seconds):
+        with self.lock:
+            now = time.monotonic()
+            slots = np.flatnonzero((self.sequences >= 0) & (self.times >= now - seconds))
+            return slots[np.argsort(self.sequences[slots])]
+
+    # rgb frames indexed [y, x], like the camera's, for these slots:
+    def rgb(self, slots):
+        pixels = self.frames[slots].transpose(0, 2, 1)
+        frames = np.empty(pixels.shape + (3,), np.uint8)
+        for channel, shift in enumerate(self.shifts):
+            np.right_shift(pixels, shift, out=frames[..., channel], casting='unsafe')
+        return frames
+
+    # write the frames as a .npz np.load() can read, frames (N, H, W, 3) and times,
+    # a chunk of frames at a time, so the whole dump is never in memory at once:
+    def save(self, seconds, filename, chunk=8):
+        start_time = time.monotonic()
+        try:
+            slots = self.slots(seconds)
+            times = self.times[slots]
+            shape = (len(slots), self.size[1], self.size[0], 3)
+            with zipfile.ZipFile(filename, 'w', allowZip64=True) as archive:
+                with archive.open('frames.npy', 'w', force_zip64=True) as f:
+                    np.lib.format.write_array_header_2_0(f, {'descr': '|u1', 'fortran_order': False, 'shape': shape})
+                    for k in range(0, len(slots), chunk):
+                        f.write(self.rgb(slots[k:k + chunk]).tobytes())
+                with archive.open('times.npy', 'w') as f:
+                    np.lib.format.write_array(f, times)
+            span = times[-1] - times[0] + 1 / self.fps if len(times) else 0
+            print('saved the last %.1fs (%s frames) to %s in %.2fs' % (span, len(slots), filename, time.monotonic() - start_time), flush=True)
+        except Exception as e:
+            print('frame ring exception: %s' % e)
+        finally:
+            self.dumping = False
+
+    # save the last `seconds` of frames, to dump_directory, without holding up the caller:
+    def dump(self, seconds=10):
+        if self.dumping:
+            return
+        self.dumping = True
+        os.makedirs(self.dump_directory, exist_ok=True)
+        filename = os.path.join(self.dump_directory, 'replay-%s.npz' % time.strftime('%Y-%m-%d_%H-%M-%S'))
+        threading.Thread(target=self.save, args=(seconds, filename), name='frame-ring-dump', daemon=True).start()
+
+    def dump_on_signal(self, signum=signal.SIGUSR2):
+        signal.signal(signum, lambda *args: self.dump())
+
+    # remove the ring file, in /dev/shm it would otherwise hold on to the RAM after we exit.
+    # (the mapping, and so any dump still copying, stays good till it is dropped)
+    def close(self):
+        try:
+            os.remove(self.filename)
+        except OSError as e:
+            print('frame ring exception: %s' % e)
+
+
+class Snapshots():
+    def __init__(self, directory, hflip=False, vflip=False):
+        self.directory = directory
+        self.hflip = hflip
+        self.vflip = vflip
+
+    # copy img now, the flip and the save happen on their own thread:
+    def take(self, img):
+        img = img.copy()
+        filename = os.path.join(self.directory, 'snapshot-%s.png' % time.strftime('%Y-%m-%d_%H-%M-%S'))
+        threading.Thread(target=self.save, args=(img, filename), name='snapshot', daemon=True).start()
+
+    def save(self, img, filename):
+        start_time = time.monotonic()
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            if self.hflip or self.vflip:
+                img = pygame.transform.flip(img, self.hflip, self.vflip)
+            pygame.image.save(img, filename)
+            print('saved %sx%s snapshot to %s in %.2fs' % (img.get_width(), img.get_height(), filename, time.monotonic() - start_time), flush=True)
+        except (OSError, pygame.error) as e:
+            print('snapshot exception: %s' % e)
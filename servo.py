@@ -0,0 +1,275 @@
+#######################################################################
+# servo code for the smart car
+#
+# writing the target angle straight to a servo makes it slam into position, and shakes the camera.
+# ServoMotion instead moves each servo from where it is to where we want it,
+# limited to a max velocity and acceleration, stepped on its own thread at a fixed rate.
+# It also knows roughly when each servo will get there, so capture code can wait just that long.
+#
+# ServoCalibration holds the min/max pulse width, fine tuning trim and direction of each servo,
+# saved in servo-calibration.json so the GUI and panorama-scan share them.
+# It turns each servo's settings into an angle -> pulse width table once,
+# so writing a servo is just a table lookup.
+#
+# Author: Garry Morrison
+# email: garry.morrison _at_ gmail.com
+# Date: 18/10/2026
+# Update: 18/10/2026
+# Copyright: GPLv3
+#
+# Usage:
+#   servos = ServoMotion(write_servo, max_velocity=120, max_acceleration=600)
+#   servos.start()
+#   servos.set_position(CMD_SERVO2, 90)
+#   eta = servos.move(CMD_SERVO2, 150)
+#   servos.wait(CMD_SERVO2)
+#   servos.close()
+#
+#   calibration = ServoCalibration()
+#   write_reg(CMD_SERVO2, calibration.pulse(CMD_SERVO2, 45))
+#   calibration.set_trim(CMD_SERVO2, -3)
+#   calibration.save()
+#
+#######################################################################
+
+import json
+import math
+import os
+import threading
+import time
+from car_bus import CMD_SERVO1, CMD_SERVO2, CMD_SERVO3, CMD_SERVO4, register_names
+
+
+SERVO_MAX_PULSE_WIDTH = 2500
+SERVO_MIN_PULSE_WIDTH = 500
+
+# the pulse width tables have this many entries per degree:
+LUT_STEPS = 10
+
+calibration_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'servo-calibration.json')
+
+# servo_2, the horizontal camera servo, is mounted back to front:
+default_calibration = {
+    CMD_SERVO1: {'min_pulse': SERVO_MIN_PULSE_WIDTH, 'max_pulse': SERVO_MAX_PULSE_WIDTH, 'trim': 0, 'invert': False},
+    CMD_SERVO2: {'min_pulse': SERVO_MIN_PULSE_WIDTH, 'max_pulse': SERVO_MAX_PULSE_WIDTH, 'trim': 0, 'invert': True},
+    CMD_SERVO3: {'min_pulse': SERVO_MIN_PULSE_WIDTH, 'max_pulse': SERVO_MAX_PULSE_WIDTH, 'trim': 0, 'invert': False},
+    CMD_SERVO4: {'min_pulse': SERVO_MIN_PULSE_WIDTH, 'max_pulse': SERVO_MAX_PULSE_WIDTH, 'trim': 0, 'invert': False},
+}
+
+
+# the trim is added to the angle first, then the angle is flipped if the servo is inverted,
+# then it is mapped onto the servo's pulse width range:
+def build_pulse_table(min_pulse, max_pulse, trim, invert):
+    table = []
+    for k in range(180 * LUT_STEPS + 1):
+        angle = k / LUT_STEPS + trim
+        if invert:
+            angle = 180 - angle
+        angle = max(0, min(angle, 180))
+        table.append(int((max_pulse - min_pulse) * angle / 180 + min_pulse))
+    return table
+
+
+class ServoCalibration():
+    def __init__(self, filename=calibration_file):
+        self.filename = filename
+        self.settings = {cmd: dict(settings) for cmd, settings in default_calibration.items()}
+        self.tables = {}
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.filename) as f:
+                saved = json.load(f)
+            for cmd in self.settings:
+                self.settings[cmd].update(saved.get(register_names[cmd], {}))
+            print('loaded servo calibration from %s' % self.filename)
+        except FileNotFoundError:
+            pass
+        except (ValueError, OSError) as e:
+            print('servo calibration exception: %s' % e)
+        for cmd in self.settings:
+            self.build(cmd)
+
+    def save(self):
+        try:
+            with open(self.filename, 'w') as f:
+                json.dump({register_names[cmd]: settings for cmd, settings in self.settings.items()}, f, indent=4)
+        except OSError as e:
+            print('servo calibration exception: %s' % e)
+
+    def build(self, cmd):
+        settings = self.settings[cmd]
+        self.tables[cmd] = build_pulse_table(settings['min_pulse'], settings['max_pulse'], settings['trim'], settings['invert'])
+
+    def trim(self, cmd):
+        return self.settings[cmd]['trim']
+
+    def set_trim(self, cmd, trim):
+        self.settings[cmd]['trim'] = trim
+        self.build(cmd)
+
+    # the hot path, angle in degrees -> pulse width:
+    def pulse(self, cmd, angle):
+        k = int(angle * LUT_STEPS + 0.5)
+        table = self.tables[cmd]
+        if k < 0:
+            return table[0]
+        if k >= len(table):
+            return table[-1]
+        return table[k]
+
+
+# position and velocity of one servo, in degrees and degrees per second:
+class ServoTrajectory():
+    def __init__(self, position):
+        self.position = position
+        self.velocity = 0
+        self.target = position
+
+    def arrived(self):
+        return self.position == self.target and self.velocity == 0
+
+    # take one step of length dt towards the target, accelerating, cruising or braking as needed:
+    def step(self, dt, max_velocity, max_acceleration):
+        distance = self.target - self.position
+        if distance == 0:
+            self.velocity = 0
+            return
+        direction = 1 if distance > 0 else -1
+        speed = self.velocity * direction  # speed towards the target, negative if heading away
+
+        if speed > 0 and speed * speed / (2 * max_acceleration) >= abs(distance):
+            # time to brake, but keep creeping along so we always get there:
+            speed = max(speed - max_acceleration * dt, max_acceleration * dt)
+        else:
+            speed = min(speed + max_acceleration * dt, max_velocity)
+
+        move = speed * dt
+        if move >= abs(distance):
+            self.position = self.target
+            self.velocity = 0
+        else:
+            self.position += direction * move
+            self.velocity = direction * speed
+
+    # estimated time left till we arrive, assuming a trapezoidal velocity profile from here:
+    def eta(self, max_velocity, max_acceleration):
+        if self.arrived():
+            return 0
+        distance = abs(self.target - self.position)
+        speed = self.velocity if self.target > self.position else -self.velocity
+        t = 0
+        if speed < 0:
+            # heading the wrong way, so first we have to stop:
+            t += -speed / max_acceleration
+            distance += speed * speed / (2 * max_acceleration)
+            speed = 0
+        accel_distance = (max_velocity ** 2 - speed ** 2) / (2 * max_acceleration)
+        brake_distance = max_velocity ** 2 / (2 * max_acceleration)
+        if accel_distance + brake_distance <= distance:
+            t += (max_velocity - speed) / max_acceleration
+            t += (distance - accel_distance - brake_distance) / max_velocity
+            t += max_velocity / max_acceleration
+        else:
+            peak = math.sqrt((2 * max_acceleration * distance + speed * speed) / 2)
+            t += max(peak - speed, 0) / max_acceleration + peak / max_acceleration
+        return t
+
+
+class ServoMotion():
+    def __init__(self, write_servo, rate=50, max_velocity=120, max_acceleration=600):
+        self.write_servo = write_servo  # write_servo(cmd, angle)
+        self.rate = rate
+        self.period = 1 / rate
+        self.max_velocity = max_velocity  # degrees per second
+        self.max_acceleration = max_acceleration  # degrees per second per second
+        self.servos = {}  # cmd -> ServoTrajectory
+        self.written = {}  # cmd -> last angle written, to a tenth of a degree
+
+        self.running = False
+        self.cond = threading.Condition()
+        self.thread = None
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name='servo-motion', daemon=True)
+        self.thread.start()
+
+    def close(self):
+        with self.cond:
+            self.running = False
+            self.cond.notify_all()
+        if self.thread is not None:
+            self.thread.join(1)
+            self.thread = None
+
+    def write(self, cmd, angle):
+        angle = round(angle, 1)
+        if self.written.get(cmd) != angle:
+            self.written[cmd] = angle
+            self.write_servo(cmd, angle)
+
+    # write the current position again, eg, after the servo's calibration has changed:
+    def resend(self, cmd):
+        with self.cond:
+            if cmd in self.servos:
+                self.written.pop(cmd, None)
+                self.write(cmd, self.servos[cmd].position)
+
+    # jump straight to a position, eg, at start up when we don't know where the servo is:
+    def set_position(self, cmd, angle):
+        with self.cond:
+            self.servos[cmd] = ServoTrajectory(angle)
+            self.written.pop(cmd, None)
+            self.write(cmd, angle)
+            self.cond.notify_all()
+
+    # head towards a new target angle, returns the estimated seconds till we get there:
+    def move(self, cmd, angle):
+        with self.cond:
+            if cmd not in self.servos:
+                # first time we have seen this servo, so nothing to move from:
+                self.servos[cmd] = ServoTrajectory(angle)
+                self.write(cmd, angle)
+                self.cond.notify_all()
+                return 0
+            self.servos[cmd].target = angle
+            self.cond.notify_all()
+            return self.servos[cmd].eta(self.max_velocity, self.max_acceleration)
+
+    def eta(self, cmd):
+        with self.cond:
+            if cmd not in self.servos:
+                return 0
+            return self.servos[cmd].eta(self.max_velocity, self.max_acceleration)
+
+    def moving(self):
+        return any(not servo.arrived() for servo in self.servos.values())
+
+    # wait till the servo (or all of them, if cmd is None) has arrived:
+    def wait(self, cmd=None, timeout=None):
+        with self.cond:
+            if cmd is None:
+                return self.cond.wait_for(lambda: not self.moving(), timeout)
+            return self.cond.wait_for(lambda: cmd not in self.servos or self.servos[cmd].arrived(), timeout)
+
+    def run(self):
+        with self.cond:
+            while True:
+                self.cond.wait_for(lambda: self.moving() or not self.running)
+                if not self.running:
+                    return
+
+                next_time = time.monotonic()
+                while self.moving() and self.running:
+                    delay = next_time - time.monotonic()
+                    if delay > 0:
+                        self.cond.wait(delay)
+                        continue
+                    for cmd, servo in self.servos.items():
+                        if not servo.arrived():
+                            servo.step(self.period, self.max_velocity, self.max_acceleration)
+                            self.write(cmd, servo.position)
+                    next_time += self.period
+                    self.cond.notify_all()
@@ -0,0 +1,87 @@
+#######################################################################
+# deadman watchdog for the smart car
+#
+# the main loop does the camera, the drawing, and the event handling all on one thread,
+# so a slow VNC frame or a camera hiccup could leave the car driving with nobody in control.
+# The control loop calls heartbeat() every time around,
+# and if we don't hear from it within the deadline, the watchdog thread stops the motors.
+#
+# Author: Garry Morrison
+# email: garry.morrison _at_ gmail.com
+# Date: 18/10/2026
+# Update: 18/10/2026
+# Copyright: GPLv3
+#
+# Usage:
+#   watchdog = Watchdog(motion.stop, deadline=0.25)
+#   watchdog.start()
+#   while True:
+#       watchdog.heartbeat()
+#       ...
+#   print(watchdog.report())
+#
+#######################################################################
+
+import threading
+import time
+from histogram import Histogram
+
+
+class Watchdog():
+    def __init__(self, on_stall, deadline=0.25):
+        self.on_stall = on_stall  # called from the watchdog thread, eg, to stop the motors
+        self.deadline = deadline  # in seconds
+        self.last_heartbeat = None
+        self.stalled = False
+        self.stall_count = 0
+        self.running = False
+        self.cond = threading.Condition()
+        self.thread = None
+
+        # time between heartbeats, and how long each stall lasted, to help tune the loop budget:
+        self.intervals = Histogram()
+        self.stalls = Histogram()
+
+    def start(self):
+        self.running = True
+        self.last_heartbeat = time.monotonic()
+        self.thread = threading.Thread(target=self.run, name='watchdog', daemon=True)
+        self.thread.start()
+
+    def close(self):
+        with self.cond:
+            self.running = False
+            self.cond.notify_all()
+        if self.thread is not None:
+            self.thread.join(1)
+            self.thread = None
+
+    def heartbeat(self):
+        now = time.monotonic()
+        with self.cond:
+            interval = now - self.last_heartbeat
+            self.intervals.add(interval)
+            if self.stalled:
+                self.stalled = False
+                self.stalls.add(interval)
+                print('watchdog: control loop back after %.0fms' % (1000 * interval), flush=True)
+            self.last_heartbeat = now
+
+    def run(self):
+        with self.cond:
+            while self.running:
+                wait = self.last_heartbeat + self.deadline - time.monotonic()
+                if wait > 0 or self.stalled:
+                    self.cond.wait(wait if wait > 0 else self.deadline)
+                    continue
+                self.stalled = True
+                self.stall_count += 1
+                print('watchdog: no heartbeat for %.0fms, stopping motors' % (1000 * self.deadline), flush=True)
+                try:
+                    self.on_stall()
+                except Exception as e:
+                    print('watchdog exception: %s' % e)
+
+    def report(self):
+        return 'watchdog: %s stalls (deadline %.0fms)\n  loop interval: %s\n  stall length:  %s' % (
+            self.stall_count, 1000 * self.deadline, self.intervals.summary(), self.stalls.summary())